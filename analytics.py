@@ -0,0 +1,193 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+import answers # answer codes
+import stats # topic titles
+import retention # archived records
+
+
+# Topics whose answers are compared with the day's rating
+correlated_topics = ['energy', 'stress', 'regime', 'body']
+windows = [7, 30] # days of the rating averages
+rolling_days = 30 # window of the best and worst stretch
+trend_days = 30 # answer shares of the last trend_days against the earlier history
+min_records = 10
+min_answers = 5 # answers given fewer times are left out of trends and correlations
+min_share_change = 0.1
+
+
+def load_history(con, user_id):
+    # Columnar extract of one user's records: datetime, rating and answer codes.
+    # pandas is heavy and only needed for analytics and plots, so it is imported on first use
+    import pandas as pd
+    columns = ['datetime', 'rating'] + answers.topics
+    data = pd.read_sql_query(text('SELECT %s FROM records WHERE user_id = :user_id ORDER BY datetime'
+                                  % ', '.join(columns)), con, params={'user_id': user_id},
+                             parse_dates={'datetime': {'format': 'ISO8601'}})
+    data = retention.with_archived(data, user_id, columns)
+    data[columns[1:]] = data[columns[1:]].astype('float32') # codes with NaN for no answer
+    return data
+
+
+def rating_windows(ratings, now):
+    # (days, mean of the last days, mean of the days before them)
+    import numpy as np
+    age = (np.datetime64(now) - ratings.index.values) / np.timedelta64(1, 'D')
+    values = ratings.to_numpy()
+    result = []
+    for days in windows:
+        current = values[age < days]
+        before = values[(age >= days) & (age < 2 * days)]
+        if len(current):
+            result.append((days, current.mean(), before.mean() if len(before) else None))
+    return result
+
+
+def rolling_extremes(ratings):
+    # End dates and means of the best and worst rolling_days stretch, once
+    # the history is that long
+    import pandas as pd
+    rolling = ratings.rolling('%dD' % rolling_days).mean()
+    rolling = rolling[rolling.index >= ratings.index[0] + pd.Timedelta(days=rolling_days)]
+    if rolling.empty:
+        return None
+    return rolling.idxmax(), rolling.max(), rolling.idxmin(), rolling.min()
+
+
+def answer_trends(data, now):
+    # Per topic, the answer whose share changed most in the last trend_days
+    # against the earlier history: (topic, code, share before, share now)
+    import numpy as np
+    recent = (data['datetime'] >= now - timedelta(days=trend_days)).to_numpy()
+    codes = data[answers.topics].to_numpy()
+    trends = []
+    for i, topic in enumerate(answers.topics):
+        column = codes[:, i]
+        answered = ~np.isnan(column)
+        if not answered.any():
+            continue
+        size = int(column[answered].max()) + 1
+        before = np.bincount(column[answered & ~recent].astype(int), minlength=size)
+        after = np.bincount(column[answered & recent].astype(int), minlength=size)
+        if before.sum() < min_answers or after.sum() < min_answers:
+            continue
+        before, after = before / before.sum(), after / after.sum()
+        # rounded so that ties, like the two answers of a yes/no topic, go to the lower code
+        change = np.abs(after - before).round(9)
+        code = int(change.argmax())
+        if change[code] >= min_share_change:
+            trends.append((topic, code, before[code], after[code]))
+    return trends
+
+
+def correlations(data):
+    # Per topic: the correlation ratio between its answers and the rating,
+    # and (code, times given, mean rating, point-biserial r) per answer
+    import numpy as np
+    import pandas as pd
+    rated = data[data['rating'].notna()]
+    result = []
+    for topic in correlated_topics:
+        codes = rated[topic]
+        answered = codes.notna().to_numpy()
+        y = rated['rating'].to_numpy(float)[answered]
+        if len(y) < min_records:
+            continue
+        dummies = pd.get_dummies(codes[answered].astype(int))
+        x = dummies.to_numpy(float)
+        counts = x.sum(axis=0)
+        means = x.T @ y / counts
+        yc = y - y.mean()
+        total = (yc ** 2).sum()
+        if total == 0:
+            continue
+        xc = x - counts / len(y)
+        r = (xc.T @ yc) / np.sqrt((xc ** 2).sum(axis=0) * total)
+        eta = np.sqrt((counts * (means - y.mean()) ** 2).sum() / total)
+        keep = counts >= min_answers
+        rows = sorted(zip(dummies.columns[keep], counts[keep].astype(int), means[keep], r[keep]),
+                      key=lambda row: -row[3])
+        if len(rows) >= 2:
+            result.append((topic, eta, rows))
+    return sorted(result, key=lambda t: -t[1])
+
+
+def analyze(data, now=None):
+    now = now or datetime.now()
+    if len(data) < min_records:
+        return {'records': len(data)}
+    ratings = data.set_index('datetime')['rating'].dropna()
+    return {'records': len(data),
+            'mean': ratings.mean(),
+            'windows': rating_windows(ratings, now),
+            'extremes': rolling_extremes(ratings) if len(ratings) else None,
+            'trends': answer_trends(data, now),
+            'correlations': correlations(data)}
+
+
+def label(topic, code):
+    return answers.codebook.label(topic, code) or stats.other_key
+
+
+def format_analytics(result):
+    if result['records'] < min_records:
+        return 'Для трендов нужно хотя бы %d записей, пока их %d.' % (min_records, result['records'])
+    lines = []
+    for days, current, before in result['windows']:
+        line = 'Средняя оценка за %d дней: %.2f' % (days, current)
+        if before is not None:
+            line += ' (за %d дней до этого %.2f)' % (days, before)
+        lines.append(line)
+    if result['extremes'] is not None:
+        best_end, best, worst_end, worst = result['extremes']
+        lines.append('Лучшие %d дней: по %s, %.2f; худшие: по %s, %.2f'
+                     % (rolling_days, best_end.strftime('%Y-%m-%d'), best, worst_end.strftime('%Y-%m-%d'), worst))
+    lines.append('')
+    if result['trends']:
+        lines.append('Как изменились ответы за последние %d дней:' % trend_days)
+        for topic, code, before, now in result['trends']:
+            lines.append('%s: «%s» %d%% → %d%%' % (stats.topic_title(topic), label(topic, code),
+                                                  round(before * 100), round(now * 100)))
+    else:
+        lines.append('За последние %d дней ответы заметно не изменились.' % trend_days)
+    if result['correlations']:
+        lines.append('')
+        lines.append('Ответы и оценка дня (средняя оценка %.2f):' % result['mean'])
+        for topic, eta, rows in result['correlations']:
+            best, worst = rows[0], rows[-1]
+            lines.append('%s (связь %.2f): «%s» — %.2f, «%s» — %.2f'
+                         % (stats.topic_title(topic), eta, label(topic, best[0]), best[2],
+                            label(topic, worst[0]), worst[2]))
+    return '\n'.join(lines).strip()
+
+
+class ResultCache:
+    # Formatted analytics per (user_id, last record id, day): valid until
+    # the user's next record, and recomputed daily since the windows end
+    # today. Least recently used entries are dropped past max_entries.
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == user_id]:
+                del self.entries[key]
@@ -0,0 +1,122 @@
+import threading
+
+from sqlalchemy import select
+
+import models # bot's database model
+from replies import replies # bot's texts collection
+from survey import sep
+
+
+option_table = models.AnswerOption.__table__
+
+# Topics answered with keyboard buttons. Their answers are stored as a code
+# from answer_options plus the follow-up text in <topic>_note; code 0 is a
+# free-text answer, kept whole in the note.
+topics = [topic for topic, spec in replies.items() if spec['pairs'] and topic != 'rating']
+other_code = 0
+
+
+def note_column(topic):
+    return topic + '_note'
+
+
+def columns(names):
+    # Stored columns behind a list of answer columns
+    stored = []
+    for name in names:
+        stored.append(name)
+        if name in topics:
+            stored.append(note_column(name))
+    return stored
+
+
+class Codebook:
+    # topic -> {label: code} and back. Codes are assigned once and kept in
+    # answer_options, so editing or reordering the buttons in replies.py
+    # never changes the meaning of stored rows.
+    def __init__(self, options):
+        self.codes = {topic: {} for topic in topics}
+        self.labels = {topic: {} for topic in topics}
+        for topic, code, label in options:
+            self.codes.setdefault(topic, {})[label] = code
+            self.labels.setdefault(topic, {})[code] = label
+
+    @classmethod
+    def from_replies(cls):
+        return cls((topic, i + 1, x['key'])
+                   for topic in topics for i, x in enumerate(replies[topic]['pairs']))
+
+    def encode(self, topic, value):
+        # 'key: follow-up' -> (code, note)
+        if not value:
+            return None, None
+        key, _, note = value.partition(sep)
+        code = self.codes[topic].get(key)
+        if code is None:
+            return other_code, value
+        return code, note or None
+
+    def decode(self, topic, code, note):
+        if code is None:
+            return ''
+        if code == other_code:
+            return note or ''
+        label = self.labels[topic][code]
+        return label + sep + note if note else label
+
+    def label(self, topic, code):
+        # Button text of a code, None for free text
+        return self.labels[topic].get(code)
+
+    def encode_values(self, values):
+        # {topic: answer} -> stored column values
+        row = {}
+        for topic in topics:
+            row[topic], row[note_column(topic)] = self.encode(topic, values.get(topic))
+        return row
+
+    def decoder(self, names):
+        # Function turning a row of columns(names) back into answer text
+        steps = [(name, name in topics) for name in names]
+
+        def decode_row(row):
+            values = []
+            i = 0
+            for name, coded in steps:
+                if coded:
+                    values.append(self.decode(name, row[i], row[i + 1]))
+                    i += 2
+                else:
+                    values.append(row[i])
+                    i += 1
+            return values
+        return decode_row
+
+
+# Replaced by load() with the codes stored in the database
+codebook = Codebook.from_replies()
+lock = threading.Lock()
+
+
+def load(conn, source=None):
+    # Read the stored codes and add any button that has none yet, from
+    # source, a replies dict, or else the replies.py imported at start-up
+    global codebook
+    source = source or replies
+    with lock:
+        stored = conn.execute(select(option_table.c.topic, option_table.c.code,
+                                     option_table.c.label)).fetchall()
+        book = Codebook(stored)
+        new = []
+        for topic in topics:
+            next_code = max(book.labels[topic], default=other_code) + 1
+            for x in source[topic]['pairs']:
+                if x['key'] not in book.codes[topic]:
+                    new.append({'topic': topic, 'code': next_code, 'label': x['key']})
+                    book.codes[topic][x['key']] = next_code
+                    book.labels[topic][next_code] = x['key']
+                    next_code += 1
+        if new:
+            conn.execute(option_table.insert(), new)
+        codebook = book
+    return codebook
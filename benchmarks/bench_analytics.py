@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# /trends on multi-year synthetic histories: the vectorized analytics
+# against the same results computed with per-row Python loops, plus the
+# columnar extract from SQLite and a cache hit. Checks that both agree.
+# Usage: python benchmarks/bench_analytics.py [years ...]
+
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, deque
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas # imported by analytics on first use; loaded here so it is not timed
+
+import analytics
+import answers
+import db
+import models
+import retention
+
+
+user_id = 1
+records_per_day = 2
+
+
+def create_db(path, years, now):
+    # Answers drift over time and some go with better days, so there are
+    # trends and correlations to find
+    engine = db.init('sqlite:///' + path)
+    rng = random.Random(0)
+    codes = {topic: sorted(answers.codebook.labels[topic]) for topic in answers.topics}
+    rows = []
+    count = years * 365 * records_per_day
+    for i in range(count):
+        when = now - timedelta(hours=24 / records_per_day * (count - i))
+        row = {'user_id': user_id, 'user_name': 'bench_user', 'datetime': when,
+               'reading': '', 'day_wish': '', 'day_accomplishment': '', 'comment': ''}
+        for topic in answers.topics:
+            options = codes[topic]
+            shift = int(len(options) * i / count * rng.random())
+            row[topic] = options[min(len(options) - 1, int(rng.random() * len(options)) + shift) % len(options)]
+            row[answers.note_column(topic)] = None
+        row['rating'] = min(2, max(0, rng.randint(0, 2) + (row['energy'] == codes['energy'][0])
+                                   - (row['stress'] == codes['stress'][-1])))
+        rows.append(row)
+    with engine.begin() as con:
+        con.execute(models.Record.__table__.insert(), rows)
+    return engine
+
+
+def loop_analyze(rows, now):
+    # Reference implementation over rows of (datetime, rating, *codes)
+    topics = answers.topics
+    result = {'records': len(rows)}
+    rated = [(r[0], r[1]) for r in rows if r[1] is not None]
+    result['mean'] = sum(r for _, r in rated) / len(rated)
+    result['windows'] = []
+    for days in analytics.windows:
+        current = [r for dt, r in rated if (now - dt).total_seconds() / 86400 < days]
+        before = [r for dt, r in rated if days <= (now - dt).total_seconds() / 86400 < 2 * days]
+        if current:
+            result['windows'].append((days, sum(current) / len(current),
+                                      sum(before) / len(before) if before else None))
+    window = deque()
+    total = 0
+    best = worst = None
+    for dt, rating in rated:
+        window.append((dt, rating))
+        total += rating
+        while window[0][0] <= dt - timedelta(days=analytics.rolling_days):
+            total -= window.popleft()[1]
+        if dt >= rated[0][0] + timedelta(days=analytics.rolling_days):
+            mean = total / len(window)
+            if best is None or mean > best[1]:
+                best = (dt, mean)
+            if worst is None or mean < worst[1]:
+                worst = (dt, mean)
+    result['extremes'] = best + worst if best else None
+
+    start = now - timedelta(days=analytics.trend_days)
+    trends = []
+    for i, topic in enumerate(topics):
+        counts = {False: Counter(), True: Counter()}
+        for row in rows:
+            if row[2 + i] is not None:
+                counts[row[0] >= start][row[2 + i]] += 1
+        totals = {k: sum(c.values()) for k, c in counts.items()}
+        if min(totals.values()) < analytics.min_answers:
+            continue
+        changes = [(abs(counts[True][c] / totals[True] - counts[False][c] / totals[False]), c)
+                   for c in set(counts[False]) | set(counts[True])]
+        change, code = max(changes, key=lambda c: (round(c[0], 9), -c[1]))
+        if change >= analytics.min_share_change:
+            trends.append((topic, code, counts[False][code] / totals[False], counts[True][code] / totals[True]))
+    result['trends'] = trends
+
+    correlations = []
+    for topic in analytics.correlated_topics:
+        i = topics.index(topic)
+        pairs = [(row[2 + i], row[1]) for row in rows if row[1] is not None and row[2 + i] is not None]
+        mean = sum(r for _, r in pairs) / len(pairs)
+        total = sum((r - mean) ** 2 for _, r in pairs)
+        groups = {}
+        for code, rating in pairs:
+            groups.setdefault(code, []).append(rating)
+        eta = math.sqrt(sum(len(g) * (sum(g) / len(g) - mean) ** 2 for g in groups.values()) / total)
+        answers_rows = []
+        for code, group in groups.items():
+            if len(group) < analytics.min_answers:
+                continue
+            share = len(group) / len(pairs)
+            cov = sum(((c == code) - share) * (r - mean) for c, r in pairs)
+            var = sum(((c == code) - share) ** 2 for c, _ in pairs)
+            answers_rows.append((code, len(group), sum(group) / len(group), cov / math.sqrt(var * total)))
+        correlations.append((topic, eta, sorted(answers_rows, key=lambda row: -row[3])))
+    result['correlations'] = sorted(correlations, key=lambda t: -t[1])
+    return result
+
+
+def same(a, b):
+    if isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all(same(x, y) for x, y in zip(a, b))
+    if isinstance(a, float) or isinstance(b, float):
+        return math.isclose(a, b, rel_tol=1e-4, abs_tol=1e-6)
+    if hasattr(a, 'to_pydatetime'):
+        a = a.to_pydatetime()
+    return a == b
+
+
+def main(sizes):
+    now = datetime(2024, 6, 1, 12)
+    print('%6s %8s  %9s %9s %9s %9s' % ('years', 'records', 'query ms', 'loops ms', 'numpy ms', 'cached ms'))
+    with tempfile.TemporaryDirectory() as tmp:
+        retention.archive_dir = os.path.join(tmp, 'archive')
+        for years in sizes:
+            engine = create_db(os.path.join(tmp, 'bench_%d.db' % years), years, now)
+            cache = analytics.ResultCache()
+
+            started = time.perf_counter()
+            with engine.connect() as con:
+                data = analytics.load_history(con, user_id)
+            query = time.perf_counter() - started
+
+            rows = [(dt.to_pydatetime(), None if math.isnan(r) else int(r),
+                     *(None if math.isnan(c) else int(c) for c in codes))
+                    for dt, r, *codes in data.itertuples(index=False)]
+            started = time.perf_counter()
+            expected = loop_analyze(rows, now)
+            loops = time.perf_counter() - started
+
+            started = time.perf_counter()
+            result = analytics.analyze(data, now)
+            text = analytics.format_analytics(result)
+            vectorized = time.perf_counter() - started
+
+            key = (user_id, 0, now.date())
+            cache.put(key, text)
+            started = time.perf_counter()
+            cache.get(key)
+            cached = time.perf_counter() - started
+
+            for name in expected:
+                if not same(result[name], expected[name]):
+                    print('MISMATCH in %s: %r != %r' % (name, result[name], expected[name]))
+            print('%6d %8d  %9.1f %9.1f %9.1f %9.3f' % (years, len(data), query * 1000, loops * 1000,
+                                                       vectorized * 1000, cached * 1000))
+            engine.dispose()
+
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or [1, 5, 10])
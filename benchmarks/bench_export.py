@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Generation time and output size of each /report format for one user.
+# Usage: python benchmarks/bench_export.py [rows ...]
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import export
+import report
+from bench_report import create_db, user_id
+
+
+def build_xlsx(con):
+    target = tempfile.SpooledTemporaryFile(max_size=export.spool_size)
+    report.build_report(report.iter_records(con, user_id), target)
+    target.seek(0)
+    return [target]
+
+
+def measure(engine, fmt):
+    with engine.connect() as con:
+        started = time.perf_counter()
+        if fmt == 'xlsx':
+            parts = build_xlsx(con)
+        else:
+            parts = export.export(report.iter_records(con, user_id), fmt)
+        elapsed = time.perf_counter() - started
+    sizes = []
+    for part in parts:
+        part.seek(0, os.SEEK_END)
+        sizes.append(part.tell())
+        part.close()
+    return elapsed, sum(sizes), len(sizes)
+
+
+def main(sizes):
+    formats = ['xlsx'] + [f for f in export.formats if export.available(f)]
+    print('%8s  %-8s %9s %10s %6s' % ('rows', 'format', 'seconds', 'size KiB', 'parts'))
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows in sizes:
+            path = os.path.join(tmp, 'bench_%d.db' % rows)
+            create_db(path, rows)
+            engine = db.make_engine('sqlite:///' + path)
+            for fmt in formats:
+                elapsed, size, parts = measure(engine, fmt)
+                print('%8d  %-8s %9.2f %10.1f %6d' % (rows, fmt, elapsed, size / 1024, parts))
+            engine.dispose()
+
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or [10000, 100000])
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Per-message handler overhead: the old linear get_reply + per-message
+# ReplyKeyboardMarkup against the precompiled survey index.
+# Sends are stubbed out but still serialise reply_markup like Bot does.
+# Usage: python benchmarks/bench_handlers.py [iterations]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import ReplyKeyboardMarkup
+
+from replies import replies, help_text
+from survey import Survey, cancel_cmd, empty_markup
+
+
+class Message:
+    def __init__(self, text):
+        self.text = text
+
+    def reply_text(self, text, reply_markup=None):
+        if reply_markup is not None:
+            reply_markup.to_json()
+
+
+class Update:
+    def __init__(self, text):
+        self.message = Message(text)
+
+
+class Context:
+    def __init__(self):
+        self.user_data = {}
+
+
+def legacy_update_message(update, topic):
+    message = replies[topic]['message']
+    if len(replies[topic]['pairs']) > 0:
+        reply_kb = [[x['key']] for x in replies[topic]['pairs']]
+        reply_kb.append([cancel_cmd])
+        markup = ReplyKeyboardMarkup(reply_kb, one_time_keyboard=True, resize_keyboard=True)
+        update.message.reply_text(message, reply_markup=markup)
+    else:
+        update.message.reply_text(message, reply_markup=empty_markup)
+
+
+def legacy_get_reply(msg, topic):
+    default = replies[topic]['default_reply']
+    for x in replies[topic]['pairs']:
+        if msg == x['key']:
+            return x['reply'] if len(x['reply']) > 0 else default
+    return default
+
+
+def legacy_step(update, context, topic, next_topic):
+    # Shape of the old emotions/energy/... handlers
+    context.user_data[topic] = update.message.text
+    reply = legacy_get_reply(update.message.text, topic)
+    if reply == 'skip':
+        legacy_update_message(update, next_topic)
+        return
+    update.message.reply_text(reply)
+
+
+def main(iterations):
+    survey = Survey(replies, help_text, final_topic='rating')
+    names = [name for name in replies if name != 'rating']
+    steps = [(name, names[i + 1] if i + 1 < len(names) else 'rating',
+              replies[name]['pairs'][-1]['key'] if replies[name]['pairs'] else 'текст')
+             for i, name in enumerate(names)]
+    updates = {text: Update(text) for _, _, text in steps}
+    context = Context()
+
+    started = time.perf_counter()
+    for _ in range(iterations):
+        for name, next_topic, text in steps:
+            legacy_step(updates[text], context, name, next_topic)
+    legacy = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(iterations):
+        for name, _, text in steps:
+            survey.answer(name, updates[text], context)
+    compiled = time.perf_counter() - started
+
+    messages = iterations * len(steps)
+    print('%-9s %12s' % ('path', 'us/message'))
+    print('%-9s %12.2f' % ('legacy', legacy / messages * 1e6))
+    print('%-9s %12.2f' % ('compiled', compiled / messages * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
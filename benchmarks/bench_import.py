@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# /import of a history exported by /report, as xlsx and as csv.gz, into an
+# empty database: batched executemany transactions against one ORM commit
+# per row like the survey's old write path, timed on a subset and
+# extrapolated. A second upload of the same file is timed too, since every
+# row is then skipped as a duplicate.
+# Usage: python benchmarks/bench_import.py [--rows 100000] [--orm-rows 2000]
+
+import argparse
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_load import random_record
+
+import answers
+import db
+import export
+import importer
+import models
+import report
+import retention
+
+
+user_id = 1
+
+
+def make_files(path, rows):
+    # The files /report would send for a history of `rows` records
+    engine = db.init('sqlite:///' + path)
+    rng = random.Random(0)
+    start = datetime(2024, 1, 1) - timedelta(hours=6 * rows)
+    with engine.begin() as con:
+        con.execute(models.Record.__table__.insert(),
+                    [random_record(rng, user_id, start + timedelta(hours=6 * i)) for i in range(rows)])
+    with engine.connect() as con:
+        xlsx = io.BytesIO()
+        report.build_report(report.iter_records(con, user_id), xlsx)
+        parts = export.export(report.iter_records(con, user_id), 'csv', max_part=2 ** 40)
+        csv = parts[0].read()
+        parts[0].close()
+    engine.dispose()
+    return {'r.xlsx': xlsx.getvalue(), 'r.csv.gz': csv}
+
+
+def orm_import(engine, data, filename, limit):
+    # One session and commit per record
+    rows = importer.read_rows(io.BytesIO(data), filename)
+    started = time.perf_counter()
+    for _, values in islice(rows, limit):
+        with db.session_scope() as session:
+            session.add(models.Record(**importer.make_row(user_id, 'bench_user', values, answers.codebook)))
+    return time.perf_counter() - started
+
+
+def timed_import(engine, data, filename):
+    started = time.perf_counter()
+    summary = importer.import_file(engine, user_id, 'bench_user', io.BytesIO(data), filename)
+    return time.perf_counter() - started, summary
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--orm-rows', type=int, default=2000, help='rows committed one by one')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        retention.archive_dir = os.path.join(tmp, 'archive')
+        files = make_files(os.path.join(tmp, 'source.db'), args.rows)
+        print('%d records: xlsx %.1f MiB, csv.gz %.1f MiB' % (args.rows, len(files['r.xlsx']) / 2 ** 20,
+                                                             len(files['r.csv.gz']) / 2 ** 20))
+        print('%-10s %12s %12s %14s' % ('file', 'batched s', 'again s', 'per-row ORM s'))
+        for filename, data in files.items():
+            engine = db.init('sqlite:///' + os.path.join(tmp, filename + '.db'))
+            batched, summary = timed_import(engine, data, filename)
+            if summary['imported'] != args.rows:
+                print('IMPORTED %d of %d rows: %r' % (summary['imported'], args.rows, summary))
+            again, summary = timed_import(engine, data, filename)
+            if summary['duplicates'] != args.rows:
+                print('SKIPPED %d of %d rows on the second upload' % (summary['duplicates'], args.rows))
+            engine.dispose()
+
+            engine = db.init('sqlite:///' + os.path.join(tmp, filename + '.orm.db'))
+            limit = min(args.orm_rows, args.rows)
+            orm = orm_import(engine, data, filename, limit) * args.rows / limit
+            engine.dispose()
+            print('%-10s %12.1f %12.1f %14.1f' % (filename, batched, again, orm))
+
+
+if __name__ == '__main__':
+    main()
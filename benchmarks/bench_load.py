@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Synthetic load test of the whole bot: seeds a database with a realistic
+# records table, runs bot.py in webhook mode against the fake Bot API and
+# replays simulated users through /start_session ... rating, some of them
+# asking for a /report afterwards. Latency of each step is measured from
+# posting the update to the bot's answer arriving at the fake API.
+# Prints p50/p95/p99 per step, throughput and the bot's peak RSS; --save
+# keeps the results and --baseline fails the run when a step's p95 regressed.
+# Runs offline.
+# Usage: python benchmarks/bench_load.py [--users 300] [--concurrency 50] [--report-share 0.2]
+#        python benchmarks/bench_load.py --save base.json
+#        python benchmarks/bench_load.py --baseline base.json --tolerance 0.25
+
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_webhook import root, webhook_path, free_port, wait_for_port, post_update, free_text
+from fake_telegram import FakeTelegram, make_update, keyboard_buttons
+
+import answers
+import db
+import models
+from replies import replies
+
+
+first_user = 1000
+background_users = 2000
+insert_batch = 10000
+# p95 changes below this many milliseconds are noise, not regressions
+min_regression_ms = 2
+# Texts that end a survey or a /report
+survey_done = 'Спасибо'
+report_outcomes = {'Вот ваш отчет': 'report sent', 'Не удалось': 'report failed',
+                   'Сейчас формируется': 'report rejected', 'Новых записей': 'report empty',
+                   'За этот период': 'report empty'}
+questions = {spec['message']: topic for topic, spec in replies.items()}
+
+
+def random_record(rng, user_id, when):
+    values = {}
+    for topic in answers.topics:
+        keys = [x['key'] for x in replies[topic]['pairs']]
+        roll = rng.random()
+        values[topic] = (free_text if roll < 0.05 else
+                         rng.choice(keys) + ': подробности' if roll < 0.35 else rng.choice(keys))
+    row = answers.codebook.encode_values(values)
+    row.update(user_id=user_id, user_name='user%d' % user_id, datetime=when,
+               reading='книга', day_wish='короткая заметка', day_accomplishment='короткая заметка',
+               comment='', rating=rng.randint(0, 2))
+    return row
+
+
+def seed(db_url, users, history, background):
+    # `history` daily records for each simulated user and `background` more
+    # spread over other users, inserted in batches
+    engine = db.init(db_url)
+    rng = random.Random(0)
+    now = datetime.now()
+
+    def rows():
+        for user_id in range(first_user, first_user + users):
+            for day in range(history, 0, -1):
+                yield random_record(rng, user_id, now - timedelta(days=day))
+        for i in range(background):
+            user_id = first_user + users + i % background_users
+            yield random_record(rng, user_id, now - timedelta(hours=12 * (background - i) // background_users))
+
+    batch = []
+    with engine.begin() as con:
+        for row in rows():
+            batch.append(row)
+            if len(batch) == insert_batch:
+                con.execute(models.Record.__table__.insert(), batch)
+                batch = []
+        if batch:
+            con.execute(models.Record.__table__.insert(), batch)
+    engine.dispose()
+
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.steps = {}
+        self.outcomes = {}
+
+    def add(self, step, seconds):
+        with self.lock:
+            self.steps.setdefault(step, []).append(seconds)
+
+    def outcome(self, name):
+        with self.lock:
+            self.outcomes[name] = self.outcomes.get(name, 0) + 1
+
+
+def percentile(values, q):
+    # Nearest rank over sorted values
+    return values[min(len(values) - 1, max(0, int(round(q / 100 * len(values))) - 1))]
+
+
+class User:
+    # One simulated user. Each step posts an update and waits for the bot's
+    # answer; the step is named like the handler metrics: the command or the
+    # state the message is handled in.
+    def __init__(self, fake, url, user_id, results, rng):
+        self.chat = fake.chat(user_id)
+        self.url = url
+        self.user_id = user_id
+        self.results = results
+        self.rng = rng
+        self.received = len(self.chat.sent)
+
+    def send(self, step, text, done=None):
+        # done(message) tells when the step is over; by default the first answer
+        started = time.perf_counter()
+        post_update(self.url, make_update(self.user_id, text))
+        while True:
+            self.received += 1
+            message = self.chat.wait(self.received, timeout=120)
+            if done is None or done(message):
+                break
+        self.results.add(step, time.perf_counter() - started)
+        return message
+
+    def survey(self):
+        message = self.send('/start_session', '/start_session')
+        state = None
+        updates = 1
+        while not message.get('text', '').startswith(survey_done):
+            text = message.get('text', '')
+            state = questions[text] if text in questions else state.split('_follow_up')[0] + '_follow_up'
+            buttons = keyboard_buttons(message.get('reply_markup'))
+            message = self.send(state, self.rng.choice(buttons) if buttons else free_text)
+            updates += 1
+        self.results.outcome('surveys')
+        return updates
+
+    def report(self, fmt):
+        message = self.send('/report', '/report' if fmt == 'xlsx' else '/report ' + fmt,
+                            lambda m: m.get('text', '').startswith(tuple(report_outcomes)))
+        self.results.outcome(next(name for prefix, name in report_outcomes.items()
+                                  if message['text'].startswith(prefix)))
+        return 1
+
+
+def run_user(fake, url, user_id, results, args):
+    rng = random.Random(user_id)
+    user = User(fake, url, user_id, results, rng)
+    updates = user.survey()
+    if rng.random() < args.report_share:
+        updates += user.report(rng.choice(args.formats))
+    return updates
+
+
+def run(args):
+    results = Results()
+    fake = FakeTelegram(latency_ms=args.latency_ms).start()
+    port = free_port()
+    with tempfile.TemporaryDirectory() as tmp:
+        db_url = 'sqlite:///' + os.path.join(tmp, 'bot.db')
+        started = time.perf_counter()
+        seed(db_url, args.users, args.history, args.records)
+        print('seeded %d records in %.1f s' % (args.users * args.history + args.records,
+                                               time.perf_counter() - started))
+        env = dict(os.environ,
+                   BOT_TOKEN='123:load', BOT_API_URL=fake.base_url, BOT_MODE='webhook',
+                   WEBHOOK_LISTEN='127.0.0.1', WEBHOOK_PORT=str(port), WEBHOOK_PATH=webhook_path,
+                   WEBHOOK_URL='http://127.0.0.1:%d/%s' % (port, webhook_path),
+                   BOT_WORKERS=str(args.workers), BOT_PROCESSES=str(args.processes), DB_URL=db_url,
+                   REPORT_CACHE_DIR=os.path.join(tmp, 'reports'), ARCHIVE_DIR=os.path.join(tmp, 'archive'),
+                   OUTBOX_GLOBAL_RATE='100000', OUTBOX_CHAT_RATE='100000', OUTBOX_CHAT_BURST='100')
+        bot = subprocess.Popen([sys.executable, os.path.join(root, 'bot.py')], env=env, cwd=tmp,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(port)
+            url = 'http://127.0.0.1:%d/%s' % (port, webhook_path)
+            started = time.perf_counter()
+            with ThreadPoolExecutor(args.concurrency) as pool:
+                updates = sum(pool.map(lambda uid: run_user(fake, url, uid, results, args),
+                                       range(first_user, first_user + args.users)))
+            elapsed = time.perf_counter() - started
+        finally:
+            bot.terminate()
+            bot.wait(60)
+            fake.stop()
+    # Peak RSS of the bot and, in multi-process mode, its workers
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    return results, updates, elapsed, peak_rss
+
+
+def summary(results, updates, elapsed, peak_rss):
+    steps = {}
+    for step, values in results.steps.items():
+        values = sorted(values)
+        steps[step] = {'count': len(values),
+                       'p50': percentile(values, 50) * 1000,
+                       'p95': percentile(values, 95) * 1000,
+                       'p99': percentile(values, 99) * 1000}
+    return {'steps': steps, 'outcomes': results.outcomes, 'updates': updates, 'seconds': elapsed,
+            'updates_per_second': updates / elapsed, 'peak_rss_mib': peak_rss / 2 ** 20}
+
+
+def print_summary(result):
+    print('%-30s %7s %9s %9s %9s' % ('step', 'count', 'p50 ms', 'p95 ms', 'p99 ms'))
+    order = ['/start_session'] + [t for t in replies for t in (t, t + '_follow_up')] + ['/report']
+    for step in sorted(result['steps'], key=lambda s: order.index(s) if s in order else len(order)):
+        values = result['steps'][step]
+        print('%-30s %7d %9.1f %9.1f %9.1f' % (step, values['count'], values['p50'], values['p95'], values['p99']))
+    print()
+    for name, count in sorted(result['outcomes'].items()):
+        print('%-30s %7d' % (name, count))
+    print('%d updates in %.2f s, %.1f updates/s, %.1f surveys/s, bot peak RSS %.1f MiB'
+          % (result['updates'], result['seconds'], result['updates_per_second'],
+             result['outcomes'].get('surveys', 0) / result['seconds'], result['peak_rss_mib']))
+
+
+def regressions(result, baseline, tolerance):
+    found = []
+    for step, values in result['steps'].items():
+        before = baseline['steps'].get(step)
+        if before is None:
+            continue
+        if values['p95'] > before['p95'] * (1 + tolerance) and values['p95'] - before['p95'] > min_regression_ms:
+            found.append('%s p95 %.1f ms, was %.1f ms' % (step, values['p95'], before['p95']))
+    if result['updates_per_second'] < baseline['updates_per_second'] * (1 - tolerance):
+        found.append('throughput %.1f updates/s, was %.1f' % (result['updates_per_second'],
+                                                              baseline['updates_per_second']))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=300, help='simulated users, one survey each')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--report-share', type=float, default=0.2,
+                        help='share of users asking for a /report after the survey')
+    parser.add_argument('--formats', default='xlsx,csv', help='report formats to request')
+    parser.add_argument('--history', type=int, default=365, help='days of records per simulated user')
+    parser.add_argument('--records', type=int, default=200000, help='records of other users')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--processes', type=int, default=1, help='BOT_PROCESSES')
+    parser.add_argument('--latency-ms', type=int, default=0, help='simulated Bot API round trip per send')
+    parser.add_argument('--save', help='write the results as JSON')
+    parser.add_argument('--baseline', help='results of an earlier --save to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative p95 and throughput regression')
+    args = parser.parse_args()
+    args.formats = args.formats.split(',')
+
+    result = summary(*run(args))
+    print_summary(result)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(result, json.load(f), args.tolerance)
+        for regression in found:
+            print('REGRESSION:', regression)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Plot render time against history length: the old pyplot figure with a
+# tick per day against the resampled Figure API rendered into memory.
+# Usage: python benchmarks/bench_plot.py [days ...]
+
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import matplotlib.dates as mdates
+
+import plot
+
+
+records_per_day = 2
+
+
+def history(days):
+    index = pd.date_range('2015-01-01', periods=days * records_per_day, freq='%dh' % (24 // records_per_day))
+    return pd.Series(np.random.default_rng(0).integers(0, 3, len(index)), index=index, name='rating')
+
+
+def legacy_plot(ratings, target):
+    plt.style.use('ggplot')
+    fig, ax = plt.subplots(figsize=(25,2))
+    ax.plot(ratings.index, ratings.values)
+    ax.xaxis.set_major_locator(mdates.DayLocator())
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%b %d'))
+    ax.set_title('График продуктивности')
+    ax.set_ylabel('Продуктивность')
+    ax.set_xlabel('Дата')
+    fig.savefig(target, format='png')
+    plt.close(fig)
+
+
+def measure(func, ratings):
+    buf = io.BytesIO()
+    started = time.perf_counter()
+    func(ratings, buf)
+    return time.perf_counter() - started, buf.tell()
+
+
+def main(sizes):
+    print('%7s  %-9s %9s %10s' % ('days', 'path', 'seconds', 'png KiB'))
+    for days in sizes:
+        ratings = history(days)
+        for name, func in (('legacy', legacy_plot), ('resampled', plot.render_plot)):
+            elapsed, size = measure(func, ratings)
+            print('%7d  %-9s %9.2f %10.1f' % (days, name, elapsed, size / 1024))
+
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or [30, 365, 1825, 3650])
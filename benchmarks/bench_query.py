@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Report query latency for one user against total records table size,
+# before and after the migration that adds the records indexes.
+# Usage: python benchmarks/bench_query.py [total_rows ...]
+
+import os
+import sys
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine
+
+import models
+import migrations
+import report
+import answers
+
+
+rows_per_user = 365
+repeats = 20
+
+
+def create_db(path, total_rows):
+    engine = create_engine('sqlite:///' + path)
+    # Start from the pre-index schema so the migration has work to do
+    indexes = set(models.Record.__table__.indexes)
+    models.Record.__table__.indexes.clear()
+    try:
+        models.Base.metadata.create_all(engine)
+    finally:
+        models.Record.__table__.indexes.update(indexes)
+    con = sqlite3.connect(path)
+    start = datetime(2020, 1, 1)
+    columns = ['user_id', 'user_name'] + answers.columns(report.report_columns)
+    answer = [1, None] * len(answers.topics) + ['Нет'] * (12 - len(answers.topics))
+    con.executemany('INSERT INTO records (%s) VALUES (%s)'
+        % (', '.join(columns), ', '.join('?' * len(columns))),
+        ([i // rows_per_user, 'user%d' % (i // rows_per_user), start + timedelta(days=i % rows_per_user)]
+         + answer + [i % 3] for i in range(total_rows)))
+    con.commit()
+    con.close()
+    return engine
+
+
+def time_query(path, sql, params):
+    con = sqlite3.connect(path)
+    try:
+        started = time.perf_counter()
+        for _ in range(repeats):
+            con.execute(sql, params).fetchall()
+        return (time.perf_counter() - started) / repeats
+    finally:
+        con.close()
+
+
+def main(sizes):
+    print('%10s %14s %14s' % ('total rows', 'unindexed ms', 'indexed ms'))
+    with tempfile.TemporaryDirectory() as tmp:
+        for total in sizes:
+            path = os.path.join(tmp, 'bench_%d.db' % total)
+            engine = create_db(path, total)
+            user_id = (total // rows_per_user) // 2
+            columns = ', '.join(answers.columns(report.report_columns))
+            legacy = time_query(path, '''SELECT %s FROM records WHERE user_name='user%d' '''
+                % (columns, user_id), ())
+            migrations.run(engine)
+            indexed = time_query(path, 'SELECT %s FROM records WHERE user_id = ? ORDER BY datetime'
+                % columns, (user_id,))
+            engine.dispose()
+            print('%10d %14.2f %14.2f' % (total, legacy * 1000, indexed * 1000))
+
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or [10000, 100000, 1000000])
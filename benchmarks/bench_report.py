@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Compare the streamed xlsx report with the old pandas -> xlsx -> openpyxl path.
+# Usage: python benchmarks/bench_report.py [rows ...]
+
+import os
+import resource
+import sys
+import sqlite3
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+import openpyxl
+
+import db
+import models
+import report
+import answers
+
+
+user_id = 1
+user_name = 'bench_user'
+
+
+def create_db(path, rows):
+    engine = db.make_engine('sqlite:///' + path)
+    models.Base.metadata.create_all(engine)
+    engine.dispose()
+    con = sqlite3.connect(path)
+    columns = answers.columns(report.report_columns)
+    start = datetime(2020, 1, 1)
+    text = 'Была некоторое время: ' + 'текст ответа ' * 5
+    coded = answers.codebook.encode_values({topic: text for topic in answers.topics})
+    answer = [coded[c] if c in coded else text for c in columns[1:-1]]
+    values = [[str(start + timedelta(days=i))] + answer + [i % 3] for i in range(rows)]
+    con.executemany('INSERT INTO records (user_id, user_name, %s) VALUES (%d, ?, %s)'
+        % (', '.join(columns), user_id, ', '.join('?' * len(columns))),
+        ([user_name] + v for v in values))
+    con.commit()
+    con.close()
+
+
+def legacy_adjust_cells_shape(xlsx_filepath):
+    wb = openpyxl.load_workbook(filename = xlsx_filepath)
+    worksheet = wb.active
+    for row in worksheet.iter_rows():
+        for cell in row:
+            cell.alignment = openpyxl.styles.Alignment(wrap_text=True,vertical='top')
+    for col in worksheet.columns:
+        column = col[0].column_letter
+        worksheet.column_dimensions[column].width = 15 if column == 'A' else 30
+    wb.save(xlsx_filepath)
+
+
+def legacy_report(db_path, out_path):
+    con = sqlite3.connect(db_path)
+    df = pd.read_sql_query('''SELECT %s FROM records WHERE user_name='%s' '''
+        % (', '.join(answers.columns(report.report_columns)), user_name), con)
+    df.to_excel(out_path, index=None, header=True)
+    con.close()
+    legacy_adjust_cells_shape(out_path)
+
+
+def streamed_report(db_path, out_path):
+    engine = db.make_engine('sqlite:///' + db_path)
+    with engine.connect() as con:
+        report.build_report(report.iter_records(con, user_id), out_path)
+    engine.dispose()
+
+
+def run_child(name, db_path, out_path):
+    # Each path runs in a fresh interpreter so peak RSS is not shared between them
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+        '--run', name, db_path, out_path])
+    elapsed, peak_kib = output.split()
+    return float(elapsed), int(peak_kib)
+
+
+def main(sizes):
+    print('%8s  %-9s %9s %13s' % ('rows', 'path', 'seconds', 'peak RSS MiB'))
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows in sizes:
+            db_path = os.path.join(tmp, 'bench_%d.db' % rows)
+            create_db(db_path, rows)
+            for name in ('legacy', 'streamed'):
+                elapsed, peak = run_child(name, db_path, os.path.join(tmp, '%s.xlsx' % name))
+                print('%8d  %-9s %9.2f %13.1f' % (rows, name, elapsed, peak / 1024))
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--run']:
+        name, db_path, out_path = sys.argv[2:5]
+        func = legacy_report if name == 'legacy' else streamed_report
+        started = time.perf_counter()
+        func(db_path, out_path)
+        print(time.perf_counter() - started, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    else:
+        main([int(x) for x in sys.argv[1:]] or [1000, 10000, 100000])
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Database size and query times before and after archiving records older
+# than --days and one maintenance vacuum, on a synthetic multi-year history.
+# The full report of one user is timed too, since it now merges archives.
+# Usage: python benchmarks/bench_retention.py [--users 300] [--history 1095] [--days 365]
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+
+import bench_load
+import db
+import export
+import report
+import retention
+
+
+repeats = 5
+
+
+def timed(func):
+    func() # warm the page cache
+    started = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    return (time.perf_counter() - started) / repeats
+
+
+def measure(engine, user_id):
+    with engine.connect() as con:
+        tables = {table: size + sum(i[1] for i in indexes) for table, size, indexes in retention.sizes(con)}
+        info = retention.database_info(con)
+        recent = timed(lambda: con.execute(text(
+            "SELECT count(*), avg(rating) FROM records WHERE datetime >= datetime('now', '-30 days')")).fetchall())
+        full_report = timed(lambda: [p.close() for p in export.export(report.iter_records(con, user_id), 'csv')])
+    return {'file': info['file'], 'records': tables['records'], 'archive': info['archive'],
+            'recent': recent, 'report': full_report}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--history', type=int, default=3 * 365, help='days of records per user')
+    parser.add_argument('--days', type=int, default=365, help='archive records older than this')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        retention.archive_dir = os.path.join(tmp, 'archive')
+        url = 'sqlite:///' + os.path.join(tmp, 'bot.db')
+        bench_load.seed(url, args.users, args.history, 0)
+        engine = db.init(url)
+        user_id = bench_load.first_user
+        before = measure(engine, user_id)
+
+        started = time.perf_counter()
+        users, moved = retention.archive(engine, args.days)
+        archived = time.perf_counter() - started
+        started = time.perf_counter()
+        retention.vacuum(engine)
+        vacuumed = time.perf_counter() - started
+        after = measure(engine, user_id)
+        engine.dispose()
+
+    print('%d records of %d users, %d archived in %.1f s, vacuum %.1f s'
+          % (args.users * args.history, args.users, moved, archived, vacuumed))
+    print('%-28s %10s %10s' % ('', 'before', 'after'))
+    for name, key in (('database file MiB', 'file'), ('records + indexes MiB', 'records'),
+                      ('archive MiB', 'archive')):
+        print('%-28s %10.1f %10.1f' % (name, before[key] / 2 ** 20, after[key] / 2 ** 20))
+    for name, key in (('last 30 days, all users ms', 'recent'), ('full csv report ms', 'report')):
+        print('%-28s %10.1f %10.1f' % (name, before[key] * 1000, after[key] * 1000))
+
+
+if __name__ == '__main__':
+    main()
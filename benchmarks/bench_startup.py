@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Cold-start cost of the bot: `import bot` in a fresh interpreter and the
+# time from process spawn to the first handled update (webhook mode against
+# the fake Bot API). With --record the result is appended to
+# benchmarks/startup_history.csv under the current commit.
+# Usage: python benchmarks/bench_startup.py [--runs 5] [--record]
+
+import argparse
+import csv
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_telegram import FakeTelegram, make_update
+from bench_webhook import root, webhook_path, free_port, post_update
+
+
+history_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'startup_history.csv')
+import_snippet = 'import time; t = time.perf_counter(); import bot; print(time.perf_counter() - t)'
+
+
+def import_seconds():
+    output = subprocess.check_output([sys.executable, '-c', import_snippet], cwd=root,
+                                     stderr=subprocess.DEVNULL)
+    return float(output.split()[-1])
+
+
+def first_update_seconds():
+    # Keep posting /start until the bot answers it
+    fake = FakeTelegram().start()
+    port = free_port()
+    url = 'http://127.0.0.1:%d/%s' % (port, webhook_path)
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ,
+                   BOT_TOKEN='123:bench', BOT_API_URL=fake.base_url, BOT_MODE='webhook',
+                   WEBHOOK_LISTEN='127.0.0.1', WEBHOOK_PORT=str(port), WEBHOOK_PATH=webhook_path,
+                   WEBHOOK_URL=url,
+                   DB_URL='sqlite:///' + os.path.join(tmp, 'bot.db'), ARCHIVE_DIR=os.path.join(tmp, 'archive'))
+        started = time.perf_counter()
+        bot = subprocess.Popen([sys.executable, os.path.join(root, 'bot.py')], env=env, cwd=tmp,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            chat = fake.chat(1)
+            while True:
+                try:
+                    post_update(url, make_update(1, '/start'))
+                    break
+                except OSError:
+                    time.sleep(0.01)
+            chat.wait(1)
+            return time.perf_counter() - started
+        finally:
+            bot.terminate()
+            bot.wait(30)
+            fake.stop()
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=root,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--record', action='store_true')
+    args = parser.parse_args()
+
+    import_ms = statistics.median(import_seconds() for _ in range(args.runs)) * 1000
+    first_ms = statistics.median(first_update_seconds() for _ in range(args.runs)) * 1000
+    print('import bot:          %8.1f ms' % import_ms)
+    print('first handled update:%8.1f ms' % first_ms)
+    if args.record:
+        new_file = not os.path.exists(history_path)
+        with open(history_path, 'a', newline='') as f:
+            out = csv.writer(f)
+            if new_file:
+                out.writerow(['date', 'commit', 'import_ms', 'first_update_ms'])
+            out.writerow([date.today().isoformat(), current_commit(), '%.1f' % import_ms, '%.1f' % first_ms])
+
+
+if __name__ == '__main__':
+    main()
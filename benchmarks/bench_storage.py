@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Database size and query time with answers stored as 'key: follow-up'
+# strings against answer codes plus notes, on a synthetic history.
+# The coded database is produced by the real migration from the string one.
+# Usage: python benchmarks/bench_storage.py [rows]
+
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import answers
+import db
+import migrations
+import retention
+from replies import replies
+from survey import sep
+
+
+users = 1000
+repeats = 5
+text_topics = ['reading', 'day_wish', 'day_accomplishment', 'comment']
+
+
+def legacy_answer(rng, topic):
+    keys = [x['key'] for x in replies[topic]['pairs']]
+    roll = rng.random()
+    if roll < 0.05:
+        return 'свой вариант ответа'
+    if roll < 0.35:
+        return rng.choice(keys) + sep + 'подробности ответа'
+    return rng.choice(keys)
+
+
+def create_legacy_db(path, rows):
+    # records as they were before answer codes, with the existing indexes
+    con = sqlite3.connect(path)
+    con.execute('CREATE TABLE records (id INTEGER PRIMARY KEY, user_id INTEGER, '
+                'user_name VARCHAR(50) NOT NULL, datetime DATETIME NOT NULL, %s, rating INTEGER)'
+                % ', '.join('%s VARCHAR(500)' % c for c in migrations.legacy_columns[4:-1]))
+    con.execute('CREATE INDEX ix_records_user_id_datetime ON records (user_id, datetime)')
+    con.execute('CREATE INDEX ix_records_user_name ON records (user_name)')
+    rng = random.Random(0)
+    start = datetime(2018, 1, 1)
+    columns = migrations.legacy_columns[1:]
+
+    def generate():
+        for i in range(rows):
+            user = i % users
+            yield ([user, 'user%d' % user, str(start + timedelta(hours=12 * (i // users)))]
+                   + [legacy_answer(rng, t) for t in answers.topics]
+                   + ['книга' if t == 'reading' else 'короткая заметка' for t in text_topics]
+                   + [rng.randint(0, 2)])
+    con.executemany('INSERT INTO records (%s) VALUES (%s)'
+                    % (', '.join(columns), ', '.join('?' * len(columns))), generate())
+    con.commit()
+    con.close()
+
+
+def time_query(path, sql, params=()):
+    con = sqlite3.connect(path)
+    try:
+        con.execute(sql, params).fetchall() # warm the page cache
+        started = time.perf_counter()
+        for _ in range(repeats):
+            con.execute(sql, params).fetchall()
+        return (time.perf_counter() - started) / repeats
+    finally:
+        con.close()
+
+
+def records_size(path):
+    # Pages of the records table and its indexes after VACUUM; the coded
+    # database also holds the rollups the migration rebuilt
+    con = sqlite3.connect(path)
+    con.execute('VACUUM')
+    size = con.execute("SELECT sum(pgsize) FROM dbstat WHERE name = 'records' "
+                       "OR name LIKE 'ix_records%'").fetchone()[0]
+    con.close()
+    return size
+
+
+legacy_key = "substr(energy, 1, instr(energy || '%s', '%s') - 1)" % (sep, sep)
+queries = [
+    ('energy counts, all users',
+     'SELECT %s AS k, count(*) FROM records GROUP BY k' % legacy_key,
+     'SELECT energy, count(*) FROM records GROUP BY energy', ()),
+    ('energy counts, one user',
+     'SELECT %s AS k, count(*) FROM records WHERE user_id = ? GROUP BY k' % legacy_key,
+     'SELECT energy, count(*) FROM records WHERE user_id = ? GROUP BY energy', (users // 2,)),
+    ('mean rating by stress, all users',
+     "SELECT substr(stress, 1, instr(stress || '%s', '%s') - 1) AS k, avg(rating) "
+     'FROM records GROUP BY k' % (sep, sep),
+     'SELECT stress, avg(rating) FROM records GROUP BY stress', ()),
+]
+
+
+def main(rows):
+    with tempfile.TemporaryDirectory() as tmp:
+        retention.archive_dir = os.path.join(tmp, 'archive')
+        legacy_path = os.path.join(tmp, 'legacy.db')
+        coded_path = os.path.join(tmp, 'coded.db')
+        create_legacy_db(legacy_path, rows)
+        shutil.copy(legacy_path, coded_path)
+
+        engine = db.make_engine('sqlite:///' + coded_path)
+        started = time.perf_counter()
+        migrations.run(engine)
+        migrated = time.perf_counter() - started
+        engine.dispose()
+
+        print('%d rows, migration took %.1f s' % (rows, migrated))
+        print('%-34s %12s %12s' % ('', 'strings', 'codes'))
+        print('%-34s %12.1f %12.1f' % ('records + indexes MiB',
+              records_size(legacy_path) / 2 ** 20, records_size(coded_path) / 2 ** 20))
+        for name, legacy_sql, coded_sql, params in queries:
+            print('%-34s %12.2f %12.2f' % (name + ' ms', time_query(legacy_path, legacy_sql, params) * 1000,
+                                           time_query(coded_path, coded_sql, params) * 1000))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
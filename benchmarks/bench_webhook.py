@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# End-to-end webhook throughput: runs bot.py in webhook mode against the
+# fake Bot API and POSTs synthetic updates for simulated users walking
+# through the whole survey. No network access is needed.
+# Usage: python benchmarks/bench_webhook.py [--users 200] [--concurrency 50]
+#        python benchmarks/bench_webhook.py --compare --latency-ms 50
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_telegram import FakeTelegram, make_update, keyboard_buttons
+
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+webhook_path = 'bench'
+free_text = 'Ответ в свободной форме'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError('webhook listener did not start on port %d' % port)
+
+
+def post_update(url, update):
+    request = urllib.request.Request(url, data=json.dumps(update).encode(),
+                                     headers={'Content-Type': 'application/json'})
+    urllib.request.urlopen(request, timeout=30).read()
+
+
+def run_survey(fake, url, user_id):
+    # Answer whatever the bot asks: the first keyboard button if there is one,
+    # free text otherwise, until the final thank-you message
+    chat = fake.chat(user_id)
+    post_update(url, make_update(user_id, '/start_session'))
+    updates = 1
+    while True:
+        message = chat.wait(updates)
+        if message.get('text', '').startswith('Спасибо'):
+            return updates
+        buttons = keyboard_buttons(message.get('reply_markup'))
+        post_update(url, make_update(user_id, buttons[0] if buttons else free_text))
+        updates += 1
+
+
+def print_metrics(text):
+    # Mean time per handler state and per stage from the bot's /metrics
+    totals = {}
+    for line in text.splitlines():
+        if line.startswith(('bot_handler_seconds_', 'bot_stage_seconds_')) and '_bucket' not in line:
+            name, value = line.rsplit(' ', 1)
+            metric, labels = name.split('{')
+            totals.setdefault(labels.rstrip('}'), {})[metric.rsplit('_', 1)[1]] = float(value)
+    print('%-36s %8s %10s' % ('handler/stage', 'count', 'mean ms'))
+    for labels, values in sorted(totals.items()):
+        print('%-36s %8d %10.2f' % (labels, values['count'], values['sum'] / values['count'] * 1000))
+
+
+metrics_report = []
+
+
+def run(args, connections):
+    fake = FakeTelegram(latency_ms=args.latency_ms).start()
+    port = free_port()
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ,
+                   BOT_TOKEN='123:bench', BOT_API_URL=fake.base_url, BOT_MODE='webhook',
+                   WEBHOOK_LISTEN='127.0.0.1', WEBHOOK_PORT=str(port), WEBHOOK_PATH=webhook_path,
+                   WEBHOOK_URL='http://127.0.0.1:%d/%s' % (port, webhook_path),
+                   BOT_WORKERS=str(args.workers), BOT_OUTBOX_CONNECTIONS=str(connections),
+                   DB_URL='sqlite:///' + os.path.join(tmp, 'bot.db'), ARCHIVE_DIR=os.path.join(tmp, 'archive'))
+        if args.global_rate:
+            env['OUTBOX_GLOBAL_RATE'] = str(args.global_rate)
+        if args.chat_rate:
+            env['OUTBOX_CHAT_RATE'] = str(args.chat_rate)
+        if args.metrics:
+            metrics_port = env['METRICS_PORT'] = str(free_port())
+        bot = subprocess.Popen([sys.executable, os.path.join(root, 'bot.py')], env=env, cwd=tmp,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(port)
+            url = 'http://127.0.0.1:%d/%s' % (port, webhook_path)
+            started = time.perf_counter()
+            with ThreadPoolExecutor(args.concurrency) as pool:
+                counts = list(pool.map(lambda uid: run_survey(fake, url, uid),
+                                       range(1000, 1000 + args.users)))
+            elapsed = time.perf_counter() - started
+            if args.metrics:
+                time.sleep(0.5) # let the record writer commit the last batch
+                scraped = urllib.request.urlopen('http://127.0.0.1:%s/metrics' % metrics_port).read().decode()
+        finally:
+            bot.terminate()
+            bot.wait(30)
+            fake.stop()
+    if args.metrics:
+        metrics_report.append(scraped)
+    return len(counts), sum(counts), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--connections', type=int, default=8,
+                        help='outbox connections, 0 sends replies from the handler thread')
+    parser.add_argument('--latency-ms', type=int, default=0,
+                        help='simulated Bot API round trip per send')
+    parser.add_argument('--global-rate', type=float,
+                        help='outbox messages per second; the bot default matches Telegram limits')
+    parser.add_argument('--chat-rate', type=float,
+                        help='outbox messages per second per chat; simulated users answer instantly')
+    parser.add_argument('--metrics', action='store_true',
+                        help='print per-state handler and per-stage times from the bot\'s /metrics')
+    parser.add_argument('--compare', action='store_true',
+                        help='run with blocking replies and with the outbox')
+    args = parser.parse_args()
+
+    modes = [('blocking', 0), ('outbox', args.connections or 8)] if args.compare \
+        else [('outbox' if args.connections else 'blocking', args.connections)]
+    print('%-9s %8s %8s %9s %10s %10s' % ('mode', 'surveys', 'updates', 'seconds', 'updates/s', 'surveys/s'))
+    for name, connections in modes:
+        surveys, updates, elapsed = run(args, connections)
+        print('%-9s %8d %8d %9.2f %10.1f %10.1f'
+              % (name, surveys, updates, elapsed, updates / elapsed, surveys / elapsed))
+    for text in metrics_report:
+        print()
+        print_metrics(text)
+
+
+if __name__ == '__main__':
+    main()
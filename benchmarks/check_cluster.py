@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Local stand-in for a multi-worker deployment: runs bot.py with
+# BOT_PROCESSES workers in webhook mode against the fake Bot API, walks
+# simulated users through the survey concurrently and checks that every
+# survey finished, every record landed in the shared database once, and
+# every worker took part. Exits non-zero on failure.
+# Usage: python benchmarks/check_cluster.py [--processes 3] [--users 60]
+#        python benchmarks/check_cluster.py --db-url postgresql://...
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_webhook import root, webhook_path, free_port, wait_for_port, run_survey
+from fake_telegram import FakeTelegram
+
+
+def scrape(port):
+    return urllib.request.urlopen('http://127.0.0.1:%d/metrics' % port).read().decode()
+
+
+def forwarded_per_worker(text):
+    counts = {}
+    for line in text.splitlines():
+        if line.startswith('bot_forwarded_updates_total{'):
+            name, value = line.rsplit(' ', 1)
+            counts[name.split('"')[1]] = int(float(value))
+    return counts
+
+
+def count_records(db_url):
+    from sqlalchemy import create_engine, text
+    engine = create_engine(db_url)
+    with engine.connect() as con:
+        rows = con.execute(text('SELECT user_id, count(*) FROM records GROUP BY user_id')).fetchall()
+    engine.dispose()
+    return dict(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int, default=3)
+    parser.add_argument('--users', type=int, default=60)
+    parser.add_argument('--concurrency', type=int, default=30)
+    parser.add_argument('--db-url', help='shared database, a fresh SQLite file by default')
+    args = parser.parse_args()
+
+    fake = FakeTelegram().start()
+    port, metrics_port = free_port(), free_port()
+    with tempfile.TemporaryDirectory() as tmp:
+        db_url = args.db_url or 'sqlite:///' + os.path.join(tmp, 'bot.db')
+        env = dict(os.environ,
+                   BOT_TOKEN='123:check', BOT_API_URL=fake.base_url, BOT_MODE='webhook',
+                   WEBHOOK_LISTEN='127.0.0.1', WEBHOOK_PORT=str(port), WEBHOOK_PATH=webhook_path,
+                   WEBHOOK_URL='http://127.0.0.1:%d/%s' % (port, webhook_path),
+                   BOT_PROCESSES=str(args.processes), DB_URL=db_url, METRICS_PORT=str(metrics_port),
+                   REPORT_CACHE_DIR=os.path.join(tmp, 'reports'), ARCHIVE_DIR=os.path.join(tmp, 'archive'),
+                   OUTBOX_GLOBAL_RATE='1000', OUTBOX_CHAT_RATE='1000')
+        bot = subprocess.Popen([sys.executable, os.path.join(root, 'bot.py')], env=env, cwd=tmp,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(port)
+            url = 'http://127.0.0.1:%d/%s' % (port, webhook_path)
+            user_ids = range(1000, 1000 + args.users)
+            started = time.perf_counter()
+            with ThreadPoolExecutor(args.concurrency) as pool:
+                updates = sum(pool.map(lambda uid: run_survey(fake, url, uid), user_ids))
+            elapsed = time.perf_counter() - started
+            forwarded = forwarded_per_worker(scrape(metrics_port))
+        finally:
+            bot.terminate()
+            bot.wait(60)
+            fake.stop()
+        records = count_records(db_url)
+
+    print('%d surveys, %d updates in %.2f s across %d workers' % (args.users, updates, elapsed, args.processes))
+    print('updates per worker: %s' % ', '.join('%s: %d' % item for item in sorted(forwarded.items())))
+    failures = []
+    if len(forwarded) != args.processes or min(forwarded.values()) == 0:
+        failures.append('not every worker received updates')
+    missing = [uid for uid in user_ids if records.get(uid) != 1]
+    if missing:
+        failures.append('%d users without exactly one record, e.g. %s' % (len(missing), missing[:5]))
+    for failure in failures:
+        print('FAIL:', failure)
+    if not failures:
+        print('OK')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
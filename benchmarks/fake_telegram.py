@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# Offline stand-in for the Telegram Bot API and synthetic update factory.
+# Point the bot at it with BOT_API_URL=http://127.0.0.1:<port>/bot and,
+# for uploaded files, BOT_FILE_URL=http://127.0.0.1:<port>/file/bot
+
+import itertools
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+
+bot_user = {'id': 1, 'is_bot': True, 'first_name': 'bench_bot', 'username': 'bench_bot'}
+multipart_chat_id = re.compile(rb'name="chat_id"\r\n\r\n(-?\d+)')
+
+update_ids = itertools.count(1)
+message_ids = itertools.count(1)
+
+
+def make_update(user_id, text):
+    message = {
+        'message_id': next(message_ids),
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'user%d' % user_id,
+                 'username': 'user%d' % user_id},
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': next(update_ids), 'message': message}
+
+
+def make_document_update(user_id, file_id, file_name, size):
+    # A file sent by the user; its bytes are served by FakeTelegram.add_file
+    update = make_update(user_id, '')
+    message = update['message']
+    del message['text']
+    message['document'] = {'file_id': file_id, 'file_unique_id': 'u' + file_id,
+                           'file_name': file_name, 'file_size': size}
+    return update
+
+
+def keyboard_buttons(reply_markup):
+    # Button texts of a sent reply keyboard, without /commands
+    if not reply_markup:
+        return []
+    if isinstance(reply_markup, str):
+        reply_markup = json.loads(reply_markup)
+    return [button if isinstance(button, str) else button['text']
+            for row in reply_markup.get('keyboard', []) for button in row
+            if not (button if isinstance(button, str) else button['text']).startswith('/')]
+
+
+class Chat:
+    # Messages the bot sent to one chat, with a condition to wait on
+    def __init__(self):
+        self.sent = []
+        self.condition = threading.Condition()
+
+    def add(self, message):
+        with self.condition:
+            self.sent.append(message)
+            self.condition.notify_all()
+
+    def wait(self, count, timeout=30):
+        # Wait until at least count messages were sent to this chat
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.sent) >= count, timeout):
+                raise TimeoutError('bot sent %d of %d messages' % (len(self.sent), count))
+            return self.sent[count - 1]
+
+
+class FakeTelegram:
+    def __init__(self, host='127.0.0.1', port=0, latency_ms=0):
+        # latency_ms delays every send call, like a round trip to the real API
+        self.latency = latency_ms / 1000
+        self.chats = {}
+        self.files = {} # file_id -> bytes, for getFile and downloads
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.server = ThreadingHTTPServer((host, port), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d/bot' % (host, port)
+
+    @property
+    def base_file_url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d/file/bot' % (host, port)
+
+    def add_file(self, file_id, data):
+        with self.lock:
+            self.files[file_id] = data
+
+    def chat(self, chat_id):
+        with self.lock:
+            if chat_id not in self.chats:
+                self.chats[chat_id] = Chat()
+            return self.chats[chat_id]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, method, params):
+        with self.lock:
+            self.calls += 1
+        if method == 'getMe':
+            return bot_user
+        if method in ('setWebhook', 'deleteWebhook'):
+            return True
+        if method == 'getFile':
+            file_id = params.get('file_id')
+            return {'file_id': file_id, 'file_unique_id': 'u' + file_id,
+                    'file_size': len(self.files[file_id]), 'file_path': 'documents/' + file_id}
+        if method == 'getUpdates':
+            time.sleep(float(params.get('timeout') or 0))
+            return []
+        if self.latency:
+            time.sleep(self.latency)
+        chat_id = int(params.get('chat_id', 0))
+        message = {'message_id': next(message_ids), 'date': int(time.time()), 'from': bot_user,
+                   'chat': {'id': chat_id, 'type': 'private'}}
+        if method == 'sendMessage':
+            message['text'] = params.get('text', '')
+            message['reply_markup'] = params.get('reply_markup')
+        elif method == 'sendDocument':
+            message['document'] = {'file_id': 'file%d' % message['message_id'],
+                                   'file_unique_id': 'u%d' % message['message_id']}
+        self.chat(chat_id).add(message)
+        result = dict(message)
+        result.pop('reply_markup', None)
+        return result
+
+    def handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                content_type = self.headers.get('Content-Type', '')
+                if content_type.startswith('application/json'):
+                    params = json.loads(body or b'{}')
+                elif content_type.startswith('multipart/form-data'):
+                    match = multipart_chat_id.search(body)
+                    params = {'chat_id': match.group(1).decode() if match else 0}
+                else:
+                    params = dict(parse_qsl(body.decode()))
+                method = self.path.rstrip('/').rsplit('/', 1)[-1]
+                payload = json.dumps({'ok': True, 'result': fake.handle(method, params)}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                if not self.path.startswith('/file/'):
+                    return self.do_POST()
+                data = fake.files.get(self.path.rsplit('/', 1)[-1])
+                if data is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
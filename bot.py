@@ -1,25 +1,39 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
 import logging
 import os
+import shutil
+import tempfile
+import time
 from datetime import datetime
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
-from telegram import ParseMode
-from telegram import ReplyKeyboardMarkup
-from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters, ConversationHandler)
-
-from sqlalchemy import create_engine 
-from sqlalchemy.orm import sessionmaker
-
-import pandas as pd # xlsx table generation
-import sqlite3 # database
-import openpyxl # table shape adjustment
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
+from telegram import Bot, Update
+from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters, ConversationHandler, TypeHandler)
+from telegram.utils.request import Request
+from sqlalchemy.exc import IntegrityError
 
 from replies import replies, help_text # bot's texts collection
 import models # bot's database model
+import answers # answer codes
+import db # engine and per-call sessions
+import writer # batched write-behind for survey records
+from persistence import SQLPersistence # in-flight surveys across restarts
+from outbox import Outbox, QueuedBot, wait_sent # non-blocking replies
+from survey import Survey, CachedKeyboardMarkup, empty_markup # table-driven survey state machine
+import report # streamed xlsx report builder
+import export # streamed csv/json/parquet exports
+import plot # productivity plot
+import stats # per-user rollups
+import analytics # rating trends and answer correlations
+import importer # bulk import of past records
+import retention # archival and compaction
+from report_cache import ReportCache # built reports and their Telegram file_ids
+from scheduler import ReminderScheduler, parse_minute, format_minute, next_due # check-in reminders
+import metrics # latency histograms, counters and the /metrics endpoint
+import cluster # multi-process mode sharded by chat
 
 
 # Enable logging
@@ -28,308 +42,429 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
 
 logger = logging.getLogger(__name__)
 
-EMOTIONS_2, EMOTIONS, ENERGY, ENERGY_2, ATTENTION, ATTENTION_2,\
-    CONSCIENTIOUSNESS, CONSCIENTIOUSNESS_2, PLANNING, PLANNING_2,\
-    STRESS, STRESS_2, REGIME, REGIME_2, BODY, BODY_2, READING, READING_2,\
-        DAY_WISH, DAY_ACCOMPLISHMENT, COMMENT, RATING = range(22)
-
-cancel_cmd = '/cancel'
-entry_reply_keyboard = [['/start_session'], ['/comment'], ['/report', '/help']]
-entry_markup = ReplyKeyboardMarkup(entry_reply_keyboard, one_time_keyboard=True, resize_keyboard=True)
-empty_markup = ReplyKeyboardMarkup([[cancel_cmd]], one_time_keyboard=True, resize_keyboard=True)
+# Survey states, keyboards and follow-up branches are compiled from replies
+survey = Survey(replies, help_text, final_topic='rating')
 
+entry_reply_keyboard = [['/start_session'], ['/comment'], ['/report', '/stats', '/trends', '/help']]
+entry_markup = CachedKeyboardMarkup(entry_reply_keyboard, one_time_keyboard=True, resize_keyboard=True)
 
-# Enable database
-def init_db():
-    engine = create_engine('sqlite:////root/telegram_bot/bot.db', echo=True)
-    models.Base.metadata.create_all(engine)
-    Session = sessionmaker()
-    Session.configure(bind=engine)
-    return Session()
 
-db_session = init_db()
+# Database writes; the engine itself is opened by main()
+record_writer = writer.RecordWriter(max_batch=int(os.environ.get('WRITE_BATCH_SIZE', 50)),
+                                    max_delay_ms=int(os.environ.get('WRITE_BATCH_DELAY_MS', 200)))
 
 
 def update_db(user, d):
-    record = models.Record(
+    with metrics.stage_seconds.time('record_build'):
+        record = make_record(user, d)
+    with metrics.stage_seconds.time('record_submit'):
+        return record_writer.submit(record)
+
+
+def make_record(user, d):
+    # Keyboard answers are stored as codes, see answers.py
+    return models.Record(
         user_id = user['id'],
-        user_name = user['username'],
+        user_name = user['username'] or '',
         datetime = datetime.now(),
-        emotions = d.get('emotions',''),
-        energy = d.get('energy',''),
-        attention = d.get('attention',''),
-        conscientiousness = d.get('conscientiousness',''),
-        planning = d.get('planning',''),
-        stress = d.get('stress',''),
-        regime = d.get('regime',''),
-        body = d.get('body',''),
+        **answers.codebook.encode_values(d),
         reading = d.get('reading',''),
         day_wish = d.get('day_wish',''),
         day_accomplishment = d.get('day_accomplishment',''),
         comment = d.get('comment',''),
         rating = int(d['rating'])
     )
-    db_session.add(record)
-    db_session.commit()
-
-
-def generate_plot(username):
-    # Read sqlite query results into a pandas DataFrame
-    con = sqlite3.connect("/root/telegram_bot/bot.db")
-    data = pd.read_sql_query('''SELECT datetime, rating
-    FROM records WHERE user_name='%s' ''' % username, con, parse_dates=['datetime'])
-    con.close()
-    #set date as index
-    data.set_index('datetime',inplace=True)
-    #set ggplot style
-    plt.style.use('ggplot')
-    #plot data
-    fig, ax = plt.subplots(figsize=(25,2))
-    ax.plot(data.index, data['rating'])
-    #set ticks every day
-    ax.xaxis.set_major_locator(mdates.DayLocator())
-    #format date
-    ax.xaxis.set_major_formatter(mdates.DateFormatter('%b %d'))
-    ax.set_title('График продуктивности')
-    ax.set_ylabel('Продуктивность')
-    ax.set_xlabel('Дата')
-    return fig
-
-
-def generate_report(update, context):
-    # Read sqlite query results into a pandas DataFrame
-    user = update.message.from_user
-    con = sqlite3.connect("/root/telegram_bot/bot.db")
-    df = pd.read_sql_query('''SELECT
-    datetime,
-    emotions,
-    energy,
-    attention,
-    conscientiousness,
-    planning,
-    stress,
-    regime,
-    body,
-    reading,
-    day_wish,
-    day_accomplishment,
-    comment,
-    rating
-    FROM records WHERE user_name='%s' ''' % user['username'], con)
-    df.to_excel('report.xlsx', index=None, header=True)
-    con.close()
-    adjust_cells_shape('report.xlsx')
-    context.bot.send_document(chat_id=update.message.chat_id, document=open('report.xlsx', 'rb'))
-    #fig = generate_plot(user['username'])
-    #fig.savefig('fig.png')
-    #context.bot.send_document(chat_id=update.message.chat_id, document=open('fig.png', 'rb'))
-    update.message.reply_text('''Вот ваш отчет''', reply_markup=entry_markup)
-    return ConversationHandler.END
 
 
-def adjust_cells_shape(xlsx_filepath):
-    wb = openpyxl.load_workbook(filename = xlsx_filepath)        
-    worksheet = wb.active
-    for row in worksheet.iter_rows():
-        for cell in row:
-            cell.alignment = openpyxl.styles.Alignment(wrap_text=True,vertical='top')
-    for col in worksheet.columns:
-        column = col[0].column_letter
-        if column == 'A':
-            width = 15
+report_pool = report.ReportPool(workers=int(os.environ.get('REPORT_WORKERS', 2)),
+                                 max_pending=int(os.environ.get('REPORT_QUEUE_SIZE', 8)))
+
+
+report_cache = None # ReportCache, set up by main()
+
+
+def build_xlsx(user_id, period, target):
+    with metrics.stage_seconds.time('report_build'), db.engine.connect() as con:
+        report.build_report(report.iter_records(con, user_id, period=period), target)
+
+
+def upload_report(bot, chat_id, key, entry, filename):
+    # Reuse Telegram's copy of an earlier upload when there is one
+    if entry.file_id is not None:
+        with metrics.stage_seconds.time('report_resend'):
+            wait_sent(bot.send_document(chat_id=chat_id, document=entry.file_id))
+        return
+    with metrics.stage_seconds.time('report_upload'), open(entry.path, 'rb') as f:
+        # the file has to outlive a queued upload
+        message = wait_sent(bot.send_document(chat_id=chat_id, document=f, filename=filename))
+    report_cache.set_file_id(key, message.document.file_id)
+
+
+send_plots = os.environ.get('REPORT_PLOT', '1') == '1'
+
+
+def send_plot(bot, chat_id, user_id, period):
+    with metrics.stage_seconds.time('plot_query'), db.engine.connect() as con:
+        ratings = plot.load_ratings(con, user_id, period)
+    if len(ratings) < 2:
+        return
+    buf = io.BytesIO()
+    with metrics.stage_seconds.time('plot_render'):
+        plot.render_plot(ratings, buf)
+    buf.seek(0)
+    bot.send_photo(chat_id=chat_id, photo=buf)
+
+
+def send_xlsx(bot, chat_id, user_id, period, key):
+    if report_cache is None:
+        with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as buf:
+            build_xlsx(user_id, period, buf)
+            buf.seek(0)
+            with metrics.stage_seconds.time('report_upload'):
+                wait_sent(bot.send_document(chat_id=chat_id, document=buf, filename='report.xlsx'))
+        return
+    entry = report_cache.get(key)
+    if entry is None:
+        entry = report_cache.put(key, lambda f: build_xlsx(user_id, period, f))
+    upload_report(bot, chat_id, key, entry, 'report.xlsx')
+
+
+def send_export(bot, chat_id, user_id, fmt, period, key):
+    # Compressed csv/json/parquet, split into parts below Telegram's upload limit.
+    # Single-part exports are cached like xlsx reports.
+    entry = report_cache.get(key) if report_cache is not None else None
+    if entry is not None:
+        upload_report(bot, chat_id, key, entry, export.filename(fmt))
+        return
+    with metrics.stage_seconds.time('export_build'), db.engine.connect() as con:
+        parts = export.export(report.iter_records(con, user_id, period=period), fmt)
+    try:
+        if len(parts) == 1 and report_cache is not None:
+            entry = report_cache.put(key, lambda f: shutil.copyfileobj(parts[0], f))
+            upload_report(bot, chat_id, key, entry, export.filename(fmt))
+            return
+        for i, part in enumerate(parts):
+            with metrics.stage_seconds.time('report_upload'):
+                wait_sent(bot.send_document(chat_id=chat_id, document=part,
+                                            filename=export.filename(fmt, i + 1, len(parts))))
+    finally:
+        for part in parts:
+            part.close()
+
+
+def send_report(bot, chat_id, user_id, fmt='xlsx', period=None):
+    # Runs on a report pool thread
+    period = period or report.Period()
+    try:
+        # a survey finished just before /report may still be in the write buffer
+        record_writer.flush()
+        with db.engine.connect() as con:
+            last_id = report.last_record_id(con, user_id)
+            if period.since_last:
+                period.after_id = report.exported_up_to(con, user_id)
+                empty = last_id <= period.after_id
+            else:
+                empty = period.restricted() and not report.has_records(con, user_id, period)
+        if empty:
+            bot.send_message(chat_id=chat_id, reply_markup=entry_markup,
+                             text='''Новых записей с прошлого отчета нет.''' if period.since_last
+                             else '''За этот период записей нет.''')
+            return
+        extension = 'xlsx' if fmt == 'xlsx' else export.formats[fmt].extension
+        key = (user_id, last_id, period.tag() + '.' + extension if period.restricted() else extension)
+        if fmt == 'xlsx':
+            send_xlsx(bot, chat_id, user_id, period, key)
         else:
-            width = 30
-        worksheet.column_dimensions[column].width = width
-    wb.save(xlsx_filepath)
-
-
-def update_message(update, topic):
-    message = replies[topic]['message']
-    if len(replies[topic]['pairs']) > 0:
-        reply_kb = [[x['key']] for x in replies[topic]['pairs']]
-        reply_kb.append([cancel_cmd])
-        markup = ReplyKeyboardMarkup(reply_kb, one_time_keyboard=True, resize_keyboard=True)
-        update.message.reply_text(message, reply_markup=markup)
-    else:
-        update.message.reply_text(message, reply_markup=empty_markup)
-
-
-def get_reply(msg,topic):
-    default = replies[topic]['default_reply']
-    for x in replies[topic]['pairs']:
-        if msg == x['key']:
-            return x['reply'] if len(x['reply']) > 0 else default
-    return default
+            send_export(bot, chat_id, user_id, fmt, period, key)
+        if period.start is None and period.end is None:
+            # only whole-history and /report new files hold every record up to last_id
+            with db.engine.begin() as con:
+                report.mark_exported(con, user_id, last_id)
+        if send_plots:
+            send_plot(bot, chat_id, user_id, period)
+        bot.send_message(chat_id=chat_id, text='''Вот ваш отчет''', reply_markup=entry_markup)
+        metrics.reports.inc('sent')
+    except Exception:
+        logger.exception('Report generation failed for user %s', user_id)
+        metrics.reports.inc('failed')
+        bot.send_message(chat_id=chat_id, text='''Не удалось сформировать отчет, попробуйте позже.''',
+                         reply_markup=entry_markup)
+
+
+def invalidate_reports(records):
+    for user_id in {record.user_id for record in records}:
+        if report_cache is not None:
+            report_cache.invalidate(user_id)
+        analytics_cache.invalidate(user_id)
+
+
+report_formats = ['xlsx'] + list(export.formats)
+report_usage = '''Отчет: /report [формат] [период]
+Форматы: %s
+Периоды: all — все записи, new — новые с прошлого отчета, week — 7 дней,
+month — этот месяц, 30d — последние 30 дней, 2024-05 — месяц,
+2024-05-01..2024-05-15 — даты включительно (любую можно опустить)'''
+
+
+def parse_report_args(args):
+    # -> (format, Period); raises ValueError
+    fmt, period = 'xlsx', report.Period()
+    for arg in args:
+        if arg.lower() in report_formats:
+            fmt = arg.lower()
+        else:
+            period = report.parse_period(arg)
+    if fmt != 'xlsx' and not export.available(fmt):
+        raise ValueError(fmt)
+    return fmt, period
 
 
-def start(update, context):
-    update.message.reply_text('''Это бот для отслеживания продуктивных состояний психики.''', reply_markup=entry_markup)
+def generate_report(update, context):
+    user = update.message.from_user
+    try:
+        fmt, period = parse_report_args(context.args or [])
+    except ValueError:
+        update.message.reply_text(report_usage % ', '.join(
+            f for f in report_formats if f == 'xlsx' or export.available(f)), reply_markup=entry_markup)
+        return ConversationHandler.END
+    # queued first, so that a fast report cannot overtake it
+    update.message.reply_text('''Готовлю отчет...''')
+    if report_pool.submit(send_report, context.bot, update.message.chat_id, user['id'], fmt, period) is None:
+        metrics.reports.inc('rejected')
+        update.message.reply_text('''Сейчас формируется слишком много отчетов, попробуйте через минуту.''',
+                                  reply_markup=entry_markup)
     return ConversationHandler.END
 
 
-def help(update, context):
-    update.message.reply_text(help_text, reply_markup=entry_markup)
+analytics_cache = analytics.ResultCache(max_entries=int(os.environ.get('ANALYTICS_CACHE_SIZE', 1000)))
+
+
+def send_analytics(bot, chat_id, user_id):
+    # Runs on a report pool thread. Computed from the user's whole history
+    # and served from the cache until their next record.
+    try:
+        # a survey finished just before /trends may still be in the write buffer
+        record_writer.flush()
+        with db.engine.connect() as con:
+            key = (user_id, report.last_record_id(con, user_id), datetime.now().date())
+        text = analytics_cache.get(key)
+        if text is None:
+            bot.send_message(chat_id=chat_id, text='''Считаю тренды...''')
+            with metrics.stage_seconds.time('analytics_query'), db.engine.connect() as con:
+                data = analytics.load_history(con, user_id)
+            with metrics.stage_seconds.time('analytics_compute'):
+                text = analytics.format_analytics(analytics.analyze(data))
+            analytics_cache.put(key, text)
+        bot.send_message(chat_id=chat_id, text=text, reply_markup=entry_markup)
+    except Exception:
+        logger.exception('Analytics failed for user %s', user_id)
+        bot.send_message(chat_id=chat_id, text='''Не удалось посчитать тренды, попробуйте позже.''',
+                         reply_markup=entry_markup)
+
+
+def show_trends(update, context):
+    # No database work on the dispatcher thread, see send_analytics
+    if report_pool.submit(send_analytics, context.bot, update.message.chat_id,
+                          update.message.from_user['id']) is None:
+        update.message.reply_text('''Сейчас формируется слишком много отчетов, попробуйте через минуту.''',
+                                  reply_markup=entry_markup)
     return ConversationHandler.END
 
 
-def start_session(update, context):
-    update_message(update, 'emotions')
-    return EMOTIONS
-
-
-def emotions(update, context):
-    context.user_data['emotions'] = update.message.text
-    reply = get_reply(update.message.text,'emotions')
-    if reply == 'skip':
-        update_message(update, 'energy')
-        return ENERGY
-    update.message.reply_text(reply)
-    return EMOTIONS_2
-
-
-sep = ': '
-
-
-def emotions_2(update, context):
-    context.user_data['emotions'] += sep + update.message.text
-    update_message(update, 'energy')
-    return ENERGY
-
-
-def energy(update, context):
-    context.user_data['energy'] = update.message.text
-    reply = get_reply(update.message.text,'energy')
-    if reply == 'skip':
-        update_message(update, 'attention')
-        return ATTENTION
-    update.message.reply_text(reply)
-    return ENERGY_2
-
-
-def energy_2(update, context):
-    context.user_data['energy'] += sep + update.message.text
-    update_message(update, 'attention')
-    return ATTENTION
-
-
-def attention(update, context):
-    context.user_data['attention'] = update.message.text
-    reply = get_reply(update.message.text,'attention')
-    if reply == 'skip':
-        update_message(update, 'conscientiousness')
-        return CONSCIENTIOUSNESS
-    update.message.reply_text(reply)
-    return ATTENTION_2
-
-
-def attention_2(update, context):
-    context.user_data['attention'] += sep + update.message.text
-    update_message(update, 'conscientiousness')
-    return CONSCIENTIOUSNESS
-
-
-def conscientiousness(update, context):
-    context.user_data['conscientiousness'] = update.message.text
-    reply = get_reply(update.message.text,'conscientiousness')
-    if reply == 'skip':
-        update_message(update, 'planning')
-        return PLANNING
-    update.message.reply_text(reply)
-    return CONSCIENTIOUSNESS_2
-
-
-def conscientiousness_2(update, context):
-    context.user_data['conscientiousness'] += sep + update.message.text
-    update_message(update, 'planning')
-    return PLANNING
+import_state = 'import'
+import_usage = '''Пришлите файл xlsx или csv с прошлыми записями в том же виде, что и /report:
+первая строка — названия колонок (%s), datetime и rating обязательны.
+Записи с той же датой и временем, что уже есть, пропускаются. /cancel — отменить.''' % ', '.join(report.report_columns)
+# Bot API servers only hand out files up to 20 MB, a local one up to 2 GB
+import_max_bytes = int(os.environ.get('IMPORT_MAX_MB', 20)) * 1024 * 1024
+import_progress_interval = 2 # seconds between progress messages
 
 
-def planning(update, context):
-    context.user_data['planning'] = update.message.text
-    update.message.reply_text(get_reply(update.message.text,'planning'))
-    return PLANNING_2
+def start_import(update, context):
+    update.message.reply_text(import_usage, reply_markup=empty_markup)
+    return import_state
 
 
-def planning_2(update, context):
-    context.user_data['planning'] += sep + update.message.text
-    update_message(update, 'body')
-    return BODY
-
-
-def stress(update, context):
-    context.user_data['stress'] = update.message.text
-    update.message.reply_text(get_reply(update.message.text,'stress'))
-    return STRESS_2
+def receive_import(update, context):
+    document = update.message.document
+    if document.file_size and document.file_size > import_max_bytes:
+        update.message.reply_text('''Файл больше %d МБ, разбейте его на части.''' % (import_max_bytes // 2 ** 20),
+                                  reply_markup=empty_markup)
+        return import_state
+    update.message.reply_text('''Загружаю файл...''')
+    if report_pool.submit(run_import, context.bot, update.message.chat_id, update.message.from_user,
+                          document.file_id, document.file_name or '') is None:
+        update.message.reply_text('''Сейчас формируется слишком много отчетов, попробуйте через минуту.''',
+                                  reply_markup=entry_markup)
+    return ConversationHandler.END
 
 
-def stress_2(update, context):
-    context.user_data['stress'] += sep + update.message.text
-    update_message(update, 'regime')
-    return REGIME
+def run_import(bot, chat_id, user, file_id, filename):
+    # Runs on a report pool thread
+    last_progress = [time.monotonic()]
+    imported = [0]
+
+    def progress(count):
+        imported[0] = count
+        now = time.monotonic()
+        if now - last_progress[0] >= import_progress_interval:
+            last_progress[0] = now
+            bot.send_message(chat_id=chat_id, text='''Импортировано %d записей...''' % count)
+
+    def invalidate():
+        if report_cache is not None:
+            report_cache.invalidate(user['id'])
+        analytics_cache.invalidate(user['id'])
+
+    try:
+        with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as buf:
+            with metrics.stage_seconds.time('import_download'):
+                bot.get_file(file_id).download(out=buf)
+            buf.seek(0)
+            with metrics.stage_seconds.time('import'):
+                summary = importer.import_file(db.engine, user['id'], user['username'] or '',
+                                               buf, filename, progress)
+    except Exception as e:
+        # Batches committed before the failure stay in the database
+        if imported[0]:
+            invalidate()
+        if isinstance(e, ValueError):
+            text = '''Не удалось прочитать файл: %s''' % e
+        else:
+            logger.exception('Import failed for user %s', user['id'])
+            text = '''Не удалось импортировать файл, попробуйте позже.'''
+        if imported[0]:
+            text += '''\nИмпортировано записей до ошибки: %d''' % imported[0]
+        bot.send_message(chat_id=chat_id, text=text, reply_markup=entry_markup)
+        return
+    if summary['imported']:
+        invalidate()
+    bot.send_message(chat_id=chat_id, text=importer.format_summary(summary), reply_markup=entry_markup)
+
+
+admin_ids = {int(x) for x in os.environ.get('ADMIN_IDS', '').replace(',', ' ').split()}
+
+
+def show_db_sizes(update, context):
+    # Table and index sizes, for the users listed in ADMIN_IDS
+    if update.message.from_user['id'] not in admin_ids:
+        return ConversationHandler.END
+    with db.engine.connect() as con:
+        text = retention.format_sizes(retention.sizes(con), retention.database_info(con))
+    update.message.reply_text(text, reply_markup=entry_markup)
+    return ConversationHandler.END
 
 
-def regime(update, context):
-    context.user_data['regime'] = update.message.text
-    update.message.reply_text(get_reply(update.message.text,'regime'))
-    return REGIME_2
+def show_stats(update, context):
+    # Served from the user_aggregates rollup, not from records
+    with db.engine.connect() as con:
+        user_stats = stats.user_stats(con, update.message.from_user['id'])
+    update.message.reply_text(stats.format_stats(user_stats), reply_markup=entry_markup)
+    return ConversationHandler.END
 
 
-def regime_2(update, context):
-    context.user_data['regime'] += sep + update.message.text
-    update_message(update, 'body')
-    return BODY
+reminder_scheduler = None # ReminderScheduler, set up by main()
+default_tz = os.environ.get('DEFAULT_TZ', 'Europe/Moscow')
+reminder_usage = '''Напоминание о дневнике:
+/remind 21:00 — каждый день в 21:00
+/remind 21:00 Europe/Moscow — с указанием часового пояса
+/remind off — выключить
+/quiet 23:00-08:00 — тихие часы, /quiet off — выключить'''
 
 
-def body(update, context):
-    context.user_data['body'] = update.message.text
-    reply = get_reply(update.message.text,'body')
-    if reply == 'skip':
-        update_message(update, 'reading')
-        return READING
-    update.message.reply_text(reply)
-    return BODY_2
+def reminder_values(reminder):
+    return {c.name: getattr(reminder, c.name) for c in models.Reminder.__table__.columns}
 
 
-def body_2(update, context):
-    context.user_data['body'] += sep + update.message.text
-    update_message(update, 'reading')
-    return READING
+def send_reminder(bot, reminder):
+    bot.send_message(chat_id=reminder['chat_id'], text='''Пора заполнить дневник: /start_session''',
+                     reply_markup=entry_markup)
 
 
-def reading(update, context):
-    context.user_data['reading'] = update.message.text
-    #update.message.reply_text(get_reply(update.message.text,'reading'))
-    update_message(update, 'day_wish')
-    return DAY_WISH
+def update_reminder(update, change):
+    # change(reminder) edits the stored reminder; returns the saved values
+    user = update.message.from_user
+    with db.session_scope() as session:
+        reminder = session.get(models.Reminder, user['id'])
+        if reminder is None:
+            reminder = models.Reminder(user_id=user['id'], minute=21 * 60, tz=default_tz, enabled=False)
+            session.add(reminder)
+        reminder.chat_id = update.message.chat_id
+        change(reminder)
+        values = reminder_values(reminder)
+    if reminder_scheduler is not None:
+        if values['enabled']:
+            reminder_scheduler.schedule(values)
+        else:
+            reminder_scheduler.cancel(values['user_id'])
+    return values
+
+
+def set_reminder(update, context):
+    args = context.args
+    if not args:
+        update.message.reply_text(reminder_usage, reply_markup=entry_markup)
+        return ConversationHandler.END
+    if args[0] == 'off':
+        update_reminder(update, lambda r: setattr(r, 'enabled', False))
+        update.message.reply_text('''Напоминание выключено.''', reply_markup=entry_markup)
+        return ConversationHandler.END
+    try:
+        minute = parse_minute(args[0])
+        tz = args[1] if len(args) > 1 else None
+        if tz is not None:
+            ZoneInfo(tz)
+    except (ValueError, ZoneInfoNotFoundError):
+        update.message.reply_text(reminder_usage, reply_markup=entry_markup)
+        return ConversationHandler.END
+
+    def change(reminder):
+        reminder.minute = minute
+        reminder.tz = tz or reminder.tz
+        reminder.enabled = True
+
+    values = update_reminder(update, change)
+    update.message.reply_text('''Напомню каждый день в %s (%s).''' % (format_minute(values['minute']), values['tz']),
+                              reply_markup=entry_markup)
+    return ConversationHandler.END
 
 
-def reading_2(update, context):
-    context.user_data['reading'] += sep + update.message.text
-    update_message(update, 'day_wish')
-    return DAY_WISH
+def set_quiet_hours(update, context):
+    args = context.args
+    try:
+        if args == ['off']:
+            start = end = None
+        else:
+            start, end = [parse_minute(x) for x in args[0].split('-')]
+    except (ValueError, IndexError):
+        update.message.reply_text(reminder_usage, reply_markup=entry_markup)
+        return ConversationHandler.END
+
+    def change(reminder):
+        reminder.quiet_start = start
+        reminder.quiet_end = end
+
+    update_reminder(update, change)
+    if start is None:
+        update.message.reply_text('''Тихие часы выключены.''', reply_markup=entry_markup)
+    else:
+        update.message.reply_text('''Тихие часы: %s-%s.''' % (format_minute(start), format_minute(end)),
+                                  reply_markup=entry_markup)
+    return ConversationHandler.END
 
 
-def day_wish(update, context):
-    context.user_data['day_wish'] = update.message.text
-    update_message(update, 'day_accomplishment')
-    return DAY_ACCOMPLISHMENT
+def start(update, context):
+    update.message.reply_text('''Это бот для отслеживания продуктивных состояний психики.''', reply_markup=entry_markup)
+    return ConversationHandler.END
 
 
-def day_accomplishment(update, context):
-    context.user_data['day_accomplishment'] = update.message.text
-    update_message(update, 'comment')
-    return COMMENT
+def help(update, context):
+    update.message.reply_text(survey.index.help_text, reply_markup=entry_markup)
+    return ConversationHandler.END
 
 
 def single_comment(update, context):
-    update_message(update, 'comment')
-    return COMMENT
-
-
-def comment(update, context):
-    context.user_data['comment'] = update.message.text
-    update_message(update, 'rating')
-    return RATING
+    return survey.ask(update, 'comment')
 
 
 def rating(update, context): #final question
@@ -338,10 +473,11 @@ def rating(update, context): #final question
         context.user_data['rating'] = int(text)
     else:
         update.message.reply_text('Введите 0, 1 или 2')
-        return RATING
+        return survey.state('rating')
 
     update_db(update.message.from_user, context.user_data)
     context.user_data.clear()
+    metrics.sessions.inc('completed')
 
     update.message.reply_text('''Спасибо! Таблицу с данными за все дни можно скачать по команде /report''', reply_markup=entry_markup)
     return ConversationHandler.END
@@ -352,62 +488,283 @@ def cancel(update, context):
     logger.info("User %s canceled the session.", user.first_name)
     update.message.reply_text('''Опрос отменен.''', reply_markup=entry_markup)
     context.user_data.clear()
+    metrics.sessions.inc('cancelled')
     return ConversationHandler.END
 
 
+def flush_persistence(context):
+    context.dispatcher.persistence.flush()
+
+
+def reload_replies(context):
+    # New and renamed buttons need codes, or their answers are stored as free text
+    if not survey.reload_if_changed():
+        return
+    try:
+        with db.engine.begin() as con:
+            answers.load(con, survey.index.replies)
+    except IntegrityError:
+        # another worker process stored the same new codes first
+        with db.engine.begin() as con:
+            answers.load(con, survey.index.replies)
+
+
+def schedule_maintenance(job_queue, minute):
+    # The job queue's scheduler only takes pytz zones, so the next local
+    # run time is computed like a reminder's and the job re-arms itself
+    due = next_due({'tz': default_tz, 'minute': minute, 'quiet_start': None, 'quiet_end': None})
+    job_queue.run_once(run_maintenance, when=max(0, due - datetime.now().timestamp()), context=minute)
+
+
+def run_maintenance(context):
+    try:
+        retention.maintain(db.engine)
+    except Exception:
+        logger.exception('Database maintenance failed')
+    schedule_maintenance(context.job_queue, context.job.context)
+
+
+def add_maintenance(job_queue):
+    # Archival of old records and database compaction, daily at
+    # MAINTENANCE_TIME in DEFAULT_TZ or never with 'off'. Runs in one
+    # process only: the front in multi-process mode.
+    when = os.environ.get('MAINTENANCE_TIME', '04:00')
+    if when != 'off':
+        schedule_maintenance(job_queue, parse_minute(when))
+
+
+def register_gauges(dispatcher, outbox):
+    registry = metrics.registry
+    registry.gauge('bot_update_queue_depth', 'Updates waiting for a dispatcher thread',
+                   lambda: dispatcher.update_queue.qsize())
+    registry.gauge('bot_record_queue_depth', 'Records waiting to be committed',
+                   lambda: record_writer.queue.qsize())
+    registry.gauge('bot_records_written_total', 'Committed survey records',
+                   lambda: record_writer.written, kind='counter')
+    registry.gauge('bot_records_failed_total', 'Survey records that failed to commit',
+                   lambda: record_writer.failed, kind='counter')
+    registry.gauge('bot_report_queue_depth', 'Reports queued or being built',
+                   lambda: report_pool.pending)
+    if outbox is not None:
+        registry.gauge('bot_outbox_queue_depth', 'Messages waiting in the outbox', outbox.pending)
+        registry.gauge('bot_outbox_sent_total', 'Messages sent by the outbox',
+                       lambda: outbox.metrics['sent'], kind='counter')
+        registry.gauge('bot_outbox_retried_total', 'Sends retried after a flood limit',
+                       lambda: outbox.metrics['retried'], kind='counter')
+        registry.gauge('bot_outbox_throttled_seconds_total', 'Time messages waited for rate limits',
+                       lambda: outbox.metrics['throttled_seconds'], kind='counter')
+
+
+def start_metrics():
+    # METRICS_PORT enables the /metrics endpoint; PROFILE_INTERVAL_MS also
+    # starts the sampling profiler, served as /profile
+    profiler = None
+    interval_ms = float(os.environ.get('PROFILE_INTERVAL_MS', 0))
+    if interval_ms > 0:
+        profiler = metrics.SamplingProfiler(interval_ms / 1000)
+        profiler.start()
+    port = int(os.environ.get('METRICS_PORT', 0))
+    if port:
+        metrics.serve(os.environ.get('METRICS_HOST', '127.0.0.1'), port, profiler)
+        logger.info('Serving metrics on port %d', port)
+    return profiler
+
+
+def stop_profiler(profiler):
+    if profiler is None:
+        return
+    profiler.stop()
+    path = os.environ.get('PROFILE_OUTPUT')
+    if path:
+        with open(path, 'w') as f:
+            f.write(profiler.collapsed())
+        logger.info('Wrote %d profile samples to %s', profiler.samples, path)
+
+
+def make_bot(token, workers, shards=1):
+    connections = int(os.environ.get('BOT_OUTBOX_CONNECTIONS', 8))
+    request = Request(con_pool_size=workers + connections + 4)
+    base_url = os.environ.get('BOT_API_URL') or None
+    base_file_url = os.environ.get('BOT_FILE_URL') or None
+    if connections == 0:
+        return Bot(token, base_url=base_url, base_file_url=base_file_url, request=request), None
+    # Replies are queued per chat and sent from the outbox loop,
+    # so handlers return without waiting on the Bot API.
+    # Worker processes share Telegram's global limit.
+    outbox = Outbox(connections,
+                    global_rate=float(os.environ.get('OUTBOX_GLOBAL_RATE', 30)) / shards,
+                    chat_rate=float(os.environ.get('OUTBOX_CHAT_RATE', 1)),
+                    chat_burst=int(os.environ.get('OUTBOX_CHAT_BURST', 3)))
+    return QueuedBot(token, base_url=base_url, base_file_url=base_file_url, request=request, outbox=outbox), outbox
+
+
+def add_handlers(dp, job_queue):
+    # Add conversation handler with the states CHOOSING, TYPING_CHOICE and TYPING_REPLY
+    # Every handler is timed, labelled by its state or command
+    entry_points = [CommandHandler('start', start),
+                    CommandHandler('start_session', survey.start),
+                    CommandHandler('comment', single_comment),
+                    CommandHandler('help', help),
+                    CommandHandler('report', generate_report),
+                    CommandHandler('stats', show_stats),
+                    CommandHandler('trends', show_trends),
+                    CommandHandler('import', start_import),
+                    CommandHandler('remind', set_reminder),
+                    CommandHandler('quiet', set_quiet_hours),
+                    CommandHandler('dbsize', show_db_sizes)]
+    for handler in entry_points:
+        metrics.instrument([handler], '/' + handler.command[0])
+    states = survey.states(final_handler=rating)
+    states[import_state] = [MessageHandler(Filters.document, receive_import),
+                            MessageHandler(Filters.text & ~Filters.command, start_import)]
+    conv_handler = ConversationHandler(
+        entry_points=entry_points,
+        states=metrics.instrument_states(states, survey.state_names()),
+        fallbacks=metrics.instrument([CommandHandler('cancel', cancel)], '/cancel'),
+        name='survey',
+        persistent=True
+    )
+
+    dp.add_handler(conv_handler)
+
+    # Write changed survey state in batches instead of on every message
+    job_queue.run_repeating(flush_persistence,
+                            interval=int(os.environ.get('PERSISTENCE_FLUSH_INTERVAL', 5)))
+    # Pick up edited survey copy from replies.py without a restart
+    job_queue.run_repeating(reload_replies,
+                            interval=int(os.environ.get('REPLIES_RELOAD_INTERVAL', 30)))
+
+
+def start_services(bot, owns=None):
+    # Database, report cache and reminders; owns(chat_id) limits the
+    # reminders to a worker's shard
+    global report_cache, reminder_scheduler
+    db.init(logger=logger)
+    report_cache = ReportCache(
+        os.environ.get('REPORT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'productivity_bot_reports')),
+        max_bytes=int(os.environ.get('REPORT_CACHE_MAX_MB', 100)) * 1024 * 1024)
+    record_writer.listeners.append(invalidate_reports)
+
+    # Reminders are rebuilt from the reminders table on every start
+    reminder_scheduler = ReminderScheduler(lambda reminder: send_reminder(bot, reminder),
+                                           rate=float(os.environ.get('REMINDER_RATE', 20)), owns=owns)
+    with db.engine.connect() as con:
+        logger.info('Scheduled %d reminders', reminder_scheduler.load(con))
+    reminder_scheduler.start()
+
+
+def stop_services(outbox, profiler):
+    reminder_scheduler.stop()
+    report_pool.shutdown()
+    record_writer.close()
+    if outbox is not None:
+        outbox.close()
+    stop_profiler(profiler)
+
+
+def check_webhook_url():
+    # Without WEBHOOK_URL PTB registers https://0.0.0.0:8443/<token> with
+    # Telegram, which then delivers no updates at all
+    if os.environ.get('BOT_MODE', 'polling') == 'webhook' and not os.environ.get('WEBHOOK_URL'):
+        raise SystemExit('BOT_MODE=webhook needs WEBHOOK_URL, the public https address of the webhook')
+
+
+def start_updates(updater, token):
+    if os.environ.get('BOT_MODE', 'polling') == 'webhook':
+        # Telegram pushes updates to the built-in HTTP listener;
+        # TLS is expected to be terminated by a reverse proxy
+        updater.start_webhook(listen=os.environ.get('WEBHOOK_LISTEN', '0.0.0.0'),
+                              port=int(os.environ.get('WEBHOOK_PORT', 8443)),
+                              url_path=os.environ.get('WEBHOOK_PATH', token),
+                              webhook_url=os.environ.get('WEBHOOK_URL'),
+                              max_connections=int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', 40)))
+    else:
+        updater.start_polling()
+
+
+def run_worker(index, count, updates):
+    # One shard of a multi-process bot: handles the updates the front
+    # forwards for its chats. Reports are cached and metrics served per worker.
+    cluster.ignore_signals()
+    os.environ['REPORT_CACHE_DIR'] = os.path.join(
+        os.environ.get('REPORT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'productivity_bot_reports')),
+        'worker-%d' % index)
+    if int(os.environ.get('METRICS_PORT', 0)):
+        os.environ['METRICS_PORT'] = str(int(os.environ['METRICS_PORT']) + 1 + index)
+    if os.environ.get('PROFILE_OUTPUT'):
+        os.environ['PROFILE_OUTPUT'] += '.worker-%d' % index
+    token = os.environ.get('BOT_TOKEN')
+    workers = int(os.environ.get('BOT_WORKERS', 4))
+    bot, outbox = make_bot(token, workers, shards=count)
+    start_services(bot, owns=lambda chat_id: cluster.shard(chat_id, count) == index)
+    persistence = SQLPersistence(db.engine)
+    updater = Updater(bot=bot, use_context=True, persistence=persistence, workers=workers)
+    add_handlers(updater.dispatcher, updater.job_queue)
+    register_gauges(updater.dispatcher, outbox)
+    profiler = start_metrics()
+    updater.job_queue.start()
+    logger.info('Worker %d of %d started', index, count)
+    cluster.feed(updates, updater.dispatcher, bot)
+    updater.job_queue.stop()
+    persistence.flush()
+    stop_services(outbox, profiler)
+
+
+def run_front(count):
+    # Receives updates and forwards each chat's updates to one worker process
+    token = os.environ.get('BOT_TOKEN')
+    # Migrations run once here, before any worker opens the database
+    db.init(logger=logger)
+    workers = cluster.Cluster(count, run_worker)
+    workers.start()
+    bot = Bot(token, base_url=os.environ.get('BOT_API_URL') or None, request=Request(con_pool_size=8))
+    updater = Updater(bot=bot, use_context=True, workers=1)
+    updater.dispatcher.add_handler(TypeHandler(Update, workers.forward))
+    add_maintenance(updater.job_queue)
+    metrics.registry.gauge('bot_workers_alive', 'Running worker processes', workers.alive)
+    profiler = start_metrics()
+    start_updates(updater, token)
+    logger.info('Forwarding updates to %d workers', count)
+    updater.idle()
+    workers.stop()
+    stop_profiler(profiler)
+
+
 def main():
+    # BOT_PROCESSES > 1 runs that many worker processes behind a front
+    # process, sharded by chat id; they share the database at DB_URL
+    check_webhook_url()
+    processes = int(os.environ.get('BOT_PROCESSES', 1))
+    if processes > 1:
+        run_front(processes)
+        return
+
     # Create the Updater and pass it your bot's token.
     # Make sure to set use_context=True to use the new context based callbacks
     # Post version 12 this will no longer be necessary
-    updater = Updater(os.environ.get('BOT_TOKEN'), use_context=True)
+    token = os.environ.get('BOT_TOKEN')
+    workers = int(os.environ.get('BOT_WORKERS', 4))
+    bot, outbox = make_bot(token, workers)
+    # Enable database
+    start_services(bot)
+    persistence = SQLPersistence(db.engine)
+    updater = Updater(bot=bot, use_context=True, persistence=persistence, workers=workers)
 
     # Get the dispatcher to register handlers
     dp = updater.dispatcher
-
-    # Add conversation handler with the states CHOOSING, TYPING_CHOICE and TYPING_REPLY
-    conv_handler = ConversationHandler(
-        entry_points=[  CommandHandler('start', start), 
-                        CommandHandler('start_session', start_session),
-                        CommandHandler('comment', single_comment),
-                        CommandHandler('help', help),
-                        CommandHandler('report', generate_report)],
-
-        states={
-            EMOTIONS: [MessageHandler(Filters.text & ~Filters.command, emotions)],
-            EMOTIONS_2: [MessageHandler(Filters.text & ~Filters.command, emotions_2)],
-            ENERGY: [MessageHandler(Filters.text & ~Filters.command, energy)],
-            ENERGY_2: [MessageHandler(Filters.text & ~Filters.command, energy_2)],
-            ATTENTION: [MessageHandler(Filters.text & ~Filters.command, attention)],
-            ATTENTION_2: [MessageHandler(Filters.text & ~Filters.command, attention_2)],
-            CONSCIENTIOUSNESS: [MessageHandler(Filters.text & ~Filters.command, conscientiousness)],
-            CONSCIENTIOUSNESS_2: [MessageHandler(Filters.text & ~Filters.command, conscientiousness_2)],
-            PLANNING: [MessageHandler(Filters.text & ~Filters.command, planning)],
-            PLANNING_2: [MessageHandler(Filters.text & ~Filters.command, planning_2)],
-            STRESS: [MessageHandler(Filters.text & ~Filters.command, stress)],
-            STRESS_2: [MessageHandler(Filters.text & ~Filters.command, stress_2)],
-            REGIME: [MessageHandler(Filters.text & ~Filters.command, regime)],
-            REGIME_2: [MessageHandler(Filters.text & ~Filters.command, regime_2)],
-            BODY: [MessageHandler(Filters.text & ~Filters.command, body)],
-            BODY_2: [MessageHandler(Filters.text & ~Filters.command, body_2)],
-            READING: [MessageHandler(Filters.text & ~Filters.command, reading)],
-            READING_2: [MessageHandler(Filters.text & ~Filters.command, reading_2)],
-            DAY_WISH: [MessageHandler(Filters.text & ~Filters.command, day_wish)],
-            DAY_ACCOMPLISHMENT: [MessageHandler(Filters.text & ~Filters.command, day_accomplishment)],
-            COMMENT: [MessageHandler(Filters.text & ~Filters.command, comment)],
-            RATING: [MessageHandler(Filters.text & ~Filters.command, rating)],
-        },
-        fallbacks=[CommandHandler('cancel', cancel)]
-    )
-
-    dp.add_handler(conv_handler)
+    add_handlers(dp, updater.job_queue)
+    add_maintenance(updater.job_queue)
+    register_gauges(dp, outbox)
+    profiler = start_metrics()
 
     # Start the Bot
-    updater.start_polling()
+    start_updates(updater, token)
 
     # Run the bot until you press Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT. This should be used most of the time, since
-    # start_polling() is non-blocking and will stop the bot gracefully.
+    # start_polling() and start_webhook() are non-blocking and will stop the bot gracefully.
     updater.idle()
+    stop_services(outbox, profiler)
 
 
 if __name__ == '__main__':
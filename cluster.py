@@ -0,0 +1,89 @@
+import logging
+import multiprocessing
+import signal
+import threading
+
+from telegram import Update
+
+import metrics # latency histograms and counters
+
+
+logger = logging.getLogger(__name__)
+
+stop_signal = None
+forwarded = metrics.registry.counter(
+    'bot_forwarded_updates_total', 'Updates forwarded to worker processes', labels=('worker',))
+
+
+def shard(chat_id, count):
+    # Python's modulo keeps negative (group) chat ids in range
+    return chat_id % count
+
+
+def update_chat_id(update):
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return 0
+
+
+class Cluster:
+    # Runs `count` worker processes, each handling the chats whose id falls
+    # in its shard. The front process receives updates (polling or webhook)
+    # and forwards each one to its chat's worker over a per-worker queue, in
+    # the order received, so a chat's conversation state only ever lives in
+    # one worker. Processes are spawned rather than forked, since the front
+    # already runs threads.
+    def __init__(self, count, target):
+        self.count = count
+        self.target = target # target(index, count, updates) runs one worker
+        self.context = multiprocessing.get_context('spawn')
+        self.queues = [self.context.Queue() for _ in range(count)]
+        self.processes = []
+
+    def start(self):
+        for index, updates in enumerate(self.queues):
+            process = self.context.Process(target=self.target, args=(index, self.count, updates),
+                                           name='worker-%d' % index)
+            process.start()
+            self.processes.append(process)
+
+    def forward(self, update, context):
+        # TypeHandler callback in the front dispatcher
+        index = shard(update_chat_id(update), self.count)
+        self.queues[index].put(update.to_dict())
+        forwarded.inc(str(index))
+
+    def alive(self):
+        return sum(process.is_alive() for process in self.processes)
+
+    def stop(self, timeout=30):
+        for updates in self.queues:
+            updates.put(stop_signal)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning('%s did not stop, terminating it', process.name)
+                process.terminate()
+
+
+def ignore_signals():
+    # Workers stop when the front sends stop_signal, not on Ctrl-C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+def feed(updates, dispatcher, bot):
+    # Move forwarded updates onto a worker's dispatcher until stop_signal
+    thread = threading.Thread(target=dispatcher.start, name='dispatcher', daemon=True)
+    thread.start()
+    while True:
+        data = updates.get()
+        if data is stop_signal:
+            break
+        dispatcher.update_queue.put(Update.de_json(data, bot))
+    # Let the dispatcher finish what was forwarded before stopping it
+    dispatcher.update_queue.join()
+    dispatcher.stop()
+    thread.join()
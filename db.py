@@ -0,0 +1,77 @@
+import os
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+import models # bot's database model
+import migrations # schema upgrades for existing databases
+import answers # answer codes
+
+
+# DB_URL may point at a shared server database such as PostgreSQL;
+# the default is a SQLite file in BOT_DATA_DIR
+data_dir = os.environ.get('BOT_DATA_DIR', '/root/telegram_bot')
+default_url = 'sqlite:///' + os.path.join(data_dir, 'bot.db')
+busy_timeout_ms = 5000
+
+engine = None
+# Records stay readable after commit, e.g. for RecordWriter listeners
+Session = sessionmaker(expire_on_commit=False)
+
+
+def sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # Takes effect on new databases only, see retention.vacuum
+    cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA busy_timeout=%d' % busy_timeout_ms)
+    cursor.close()
+
+
+def make_engine(url=None, echo=None):
+    # Configured with DB_URL, DB_POOL_SIZE and SQL_ECHO environment variables
+    url = make_url(url or os.environ.get('DB_URL', default_url))
+    if echo is None:
+        echo = os.environ.get('SQL_ECHO', '') == '1'
+    kwargs = {}
+    if url.get_backend_name() == 'sqlite':
+        if url.database not in (None, '', ':memory:'):
+            # Pooled connections are handed between dispatcher threads
+            kwargs.update(poolclass=QueuePool,
+                          pool_size=int(os.environ.get('DB_POOL_SIZE', 5)),
+                          connect_args={'check_same_thread': False, 'timeout': busy_timeout_ms / 1000})
+    else:
+        # Server connections can be dropped while idle between bursts
+        kwargs.update(pool_size=int(os.environ.get('DB_POOL_SIZE', 5)), pool_pre_ping=True)
+    new_engine = create_engine(url, echo=echo, **kwargs)
+    if url.get_backend_name() == 'sqlite':
+        event.listen(new_engine, 'connect', sqlite_pragmas)
+    return new_engine
+
+
+def init(url=None, echo=None, logger=None):
+    global engine
+    engine = make_engine(url, echo)
+    models.Base.metadata.create_all(engine)
+    migrations.run(engine, logger)
+    with engine.begin() as conn:
+        answers.load(conn)
+    Session.configure(bind=engine)
+    return engine
+
+
+@contextmanager
+def session_scope():
+    # One session per unit of work, safe to use from any dispatcher thread
+    session = Session()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
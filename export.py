@@ -0,0 +1,131 @@
+import csv
+import gzip
+import io
+import json
+import tempfile
+from datetime import datetime
+from itertools import islice
+
+import report # report columns and row source
+
+
+# Telegram bots may upload documents up to 50 MB. A part is closed once it
+# passes part_size; one more batch and the compressor's tail fit in the margin.
+part_size = 45 * 1024 * 1024
+batch_rows = 2000
+spool_size = 4 * 1024 * 1024 # parts larger than this are spooled to disk
+
+
+def batches(rows, size=batch_rows):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+class CsvExport:
+    extension = 'csv.gz'
+
+    def __init__(self, target):
+        self.gzip = gzip.GzipFile(fileobj=target, mode='wb', compresslevel=6)
+        self.text = io.TextIOWrapper(self.gzip, encoding='utf-8', newline='')
+        self.writer = csv.writer(self.text)
+        self.writer.writerow(report.report_columns)
+
+    def write(self, batch):
+        self.writer.writerows(batch)
+
+    def finish(self):
+        self.text.flush()
+        self.text.detach()
+        self.gzip.close()
+
+
+class JsonExport:
+    # A JSON array with one object per record
+    extension = 'json.gz'
+
+    def __init__(self, target):
+        self.gzip = gzip.GzipFile(fileobj=target, mode='wb', compresslevel=6)
+        self.separator = b'[\n'
+
+    def write(self, batch):
+        chunk = ',\n'.join(json.dumps(dict(zip(report.report_columns, row)), ensure_ascii=False, default=str)
+                           for row in batch).encode('utf-8')
+        self.gzip.write(self.separator + chunk)
+        self.separator = b',\n'
+
+    def finish(self):
+        self.gzip.write(b']\n' if self.separator != b'[\n' else b'[]\n')
+        self.gzip.close()
+
+
+class ParquetExport:
+    # One zstd-compressed row group per batch. pyarrow is optional and
+    # imported on first use.
+    extension = 'parquet'
+
+    def __init__(self, target):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.schema = pa.schema([('datetime', pa.timestamp('us'))]
+                                + [(c, pa.string()) for c in report.report_columns[1:-1]]
+                                + [('rating', pa.int8())])
+        self.writer = pq.ParquetWriter(target, self.schema, compression='zstd')
+
+    def write(self, batch):
+        columns = [list(c) for c in zip(*batch)]
+        columns[0] = [datetime.fromisoformat(v) if isinstance(v, str) else v for v in columns[0]]
+        self.writer.write_table(self.pa.Table.from_arrays(
+            [self.pa.array(c, type=f.type) for c, f in zip(columns, self.schema)], schema=self.schema))
+
+    def finish(self):
+        self.writer.close()
+
+
+formats = {'csv': CsvExport, 'json': JsonExport, 'parquet': ParquetExport}
+
+
+def available(fmt):
+    if fmt != 'parquet':
+        return fmt in formats
+    try:
+        import pyarrow.parquet # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def filename(fmt, part=None, parts=1):
+    extension = formats[fmt].extension
+    if parts == 1:
+        return 'report.' + extension
+    return 'report.part%d-of-%d.%s' % (part, parts, extension)
+
+
+def export(rows, fmt, max_part=None):
+    # Stream rows into compressed parts of at most about max_part bytes,
+    # each a complete file. Returns the parts rewound to the start; the
+    # caller closes them.
+    max_part = max_part or part_size
+    parts = []
+    writer = None
+    for batch in batches(rows):
+        if writer is None:
+            parts.append(tempfile.SpooledTemporaryFile(max_size=spool_size))
+            writer = formats[fmt](parts[-1])
+        writer.write(batch)
+        if parts[-1].tell() >= max_part:
+            writer.finish()
+            writer = None
+    if not parts:
+        parts.append(tempfile.SpooledTemporaryFile(max_size=spool_size))
+        writer = formats[fmt](parts[-1])
+    if writer is not None:
+        writer.finish()
+    for part in parts:
+        part.seek(0)
+    return parts
@@ -0,0 +1,292 @@
+import csv
+import io
+import zipfile
+from datetime import date, datetime
+from itertools import islice
+from xml.etree import ElementTree
+
+from sqlalchemy import select
+
+import answers # answer codes
+import models # bot's database model
+import report # report columns
+import retention # archived records
+import stats # per-user rollups
+
+
+record_table = models.Record.__table__
+
+# Files are read in the layout /report exports: a header row with
+# report_columns, in any order. datetime and rating are required.
+required_columns = ['datetime', 'rating']
+text_columns = ['reading', 'day_wish', 'day_accomplishment', 'comment']
+max_length = 500 # String(500) columns
+batch_rows = 5000 # rows per executemany and transaction
+max_errors = 5 # invalid rows quoted in the summary
+date_formats = ['%d.%m.%Y %H:%M', '%d.%m.%Y', '%d.%m.%y']
+sheet_ns = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+rel_ns = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+
+
+def xlsx_text(element):
+    # A shared or inline string: one <t>, or rich text runs of them
+    text = element.find(sheet_ns + 't')
+    if text is not None:
+        return text.text or ''
+    return ''.join(t.text or '' for t in element.iterfind('%sr/%st' % (sheet_ns, sheet_ns)))
+
+
+column_indexes = {} # 'C' -> 2
+
+
+def xlsx_column(reference):
+    # 'C12' -> 2
+    letters = reference.rstrip('0123456789')
+    column = column_indexes.get(letters)
+    if column is None:
+        column = 0
+        for char in letters.upper():
+            column = column * 26 + ord(char) - 64
+        column = column_indexes[letters] = column - 1
+    return column
+
+
+def xlsx_date_styles(archive):
+    # Indexes of the cell styles with a date format
+    from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format
+    if 'xl/styles.xml' not in archive.namelist():
+        return set()
+    styles = ElementTree.fromstring(archive.read('xl/styles.xml'))
+    formats = dict(BUILTIN_FORMATS)
+    for fmt in styles.iterfind('%snumFmts/%snumFmt' % (sheet_ns, sheet_ns)):
+        formats[int(fmt.get('numFmtId'))] = fmt.get('formatCode')
+    return {i for i, xf in enumerate(styles.iterfind('%scellXfs/%sxf' % (sheet_ns, sheet_ns)))
+            if is_date_format(formats.get(int(xf.get('numFmtId', 0))))}
+
+
+def xlsx_rows(fileobj):
+    # Streams the first sheet's XML: openpyxl's read-only cells cost several
+    # times the parse itself on a large upload. Values are str, int, float
+    # or, for date-formatted cells, datetime.
+    from openpyxl.utils.datetime import CALENDAR_MAC_1904, CALENDAR_WINDOWS_1900, from_excel
+    try:
+        archive = zipfile.ZipFile(fileobj)
+        workbook = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+        sheet_id = workbook.find('%ssheets/%ssheet' % (sheet_ns, sheet_ns)).get(rel_ns + 'id')
+        rels = ElementTree.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+        target = next(rel.get('Target') for rel in rels if rel.get('Id') == sheet_id)
+        strings = []
+        if 'xl/sharedStrings.xml' in archive.namelist():
+            strings = [xlsx_text(si) for si in ElementTree.fromstring(archive.read('xl/sharedStrings.xml'))]
+        date_styles = xlsx_date_styles(archive)
+        source = archive.open(target.lstrip('/') if target.startswith('/') else 'xl/' + target)
+    except (zipfile.BadZipFile, KeyError, StopIteration, AttributeError, ElementTree.ParseError) as e:
+        raise ValueError('это не xlsx-файл') from e
+    properties = workbook.find(sheet_ns + 'workbookPr')
+    epoch = (CALENDAR_MAC_1904 if properties is not None and properties.get('date1904') in ('1', 'true')
+             else CALENDAR_WINDOWS_1900)
+    row_tag, cell_tag, data_tag = sheet_ns + 'row', sheet_ns + 'c', sheet_ns + 'sheetData'
+    number = 0
+    try:
+        with source:
+            for event, element in ElementTree.iterparse(source, events=('start', 'end')):
+                if event == 'start':
+                    if element.tag == data_tag:
+                        sheet_data = element
+                    continue
+                if element.tag != row_tag:
+                    continue
+                index = int(element.get('r') or number + 1)
+                for _ in range(number + 1, index):
+                    yield () # rows missing from the file are empty
+                number = index
+                row = []
+                for cell in element.iter(cell_tag):
+                    reference = cell.get('r')
+                    if reference:
+                        row.extend([None] * (xlsx_column(reference) - len(row)))
+                    kind = cell.get('t')
+                    if kind == 'inlineStr':
+                        text = cell.find(sheet_ns + 'is')
+                        value = xlsx_text(text) if text is not None else None
+                    else:
+                        value = cell.findtext(sheet_ns + 'v')
+                        if value is None:
+                            pass
+                        elif kind == 's':
+                            value = strings[int(value)]
+                        elif kind in (None, 'n'):
+                            value = float(value)
+                            if int(cell.get('s', 0)) in date_styles:
+                                value = from_excel(value, epoch)
+                            elif value.is_integer():
+                                value = int(value)
+                    row.append(value)
+                yield row
+                sheet_data.clear() # drop the rows already read
+    except (ElementTree.ParseError, zipfile.BadZipFile) as e:
+        raise ValueError('файл поврежден') from e
+
+
+def csv_rows(fileobj):
+    # Plain or gzipped, like /report csv; utf-8 with or without BOM
+    head = fileobj.read(2)
+    fileobj.seek(0)
+    if head == b'\x1f\x8b':
+        import gzip
+        fileobj = gzip.GzipFile(fileobj=fileobj, mode='rb')
+    text = io.TextIOWrapper(fileobj, encoding='utf-8-sig', newline='')
+    try:
+        yield from csv.reader(text)
+    except UnicodeDecodeError as e:
+        raise ValueError('файл не в кодировке UTF-8') from e
+    except (csv.Error, OSError, EOFError) as e:
+        raise ValueError('файл поврежден') from e
+    finally:
+        text.detach()
+
+
+def read_rows(fileobj, filename):
+    # -> iterator of (line number, {column: value}) after the header
+    rows = xlsx_rows(fileobj) if filename.lower().endswith('.xlsx') else csv_rows(fileobj)
+    try:
+        header = next(rows)
+    except StopIteration:
+        raise ValueError('файл пустой')
+    header = [str(name).strip() if name is not None else '' for name in header]
+    unknown = [name for name in header if name and name not in report.report_columns]
+    if unknown:
+        raise ValueError('неизвестные колонки: %s' % ', '.join(unknown))
+    missing = [name for name in required_columns if name not in header]
+    if missing:
+        raise ValueError('нет колонок: %s' % ', '.join(missing))
+    picks = [(i, name) for i, name in enumerate(header) if name]
+    for number, row in enumerate(rows, start=2):
+        if not any(value not in (None, '') for value in row):
+            continue
+        yield number, {name: row[i] if i < len(row) else None for i, name in picks}
+
+
+def parse_datetime(value):
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    value = str(value or '').strip()
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        pass
+    for fmt in date_formats:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError('непонятная дата «%s»' % value)
+
+
+def parse_rating(value):
+    try:
+        rating = float(str(value).strip().replace(',', '.'))
+    except ValueError:
+        rating = None
+    if rating not in (0, 1, 2):
+        raise ValueError('оценка должна быть 0, 1 или 2, а не «%s»' % ('' if value is None else value))
+    return int(rating)
+
+
+def text_value(name, value):
+    value = '' if value is None else str(value).strip()
+    if len(value) > max_length:
+        raise ValueError('%s длиннее %d символов' % (name, max_length))
+    return value
+
+
+def make_row(user_id, user_name, values, codebook):
+    # Stored column values of one record; raises ValueError. Keyboard
+    # topics are encoded like live answers: text that is not one of the
+    # buttons is kept as the user's own answer.
+    row = {'user_id': user_id, 'user_name': user_name,
+           'datetime': parse_datetime(values['datetime']),
+           'rating': parse_rating(values['rating'])}
+    for topic in answers.topics:
+        answer = text_value(topic, values.get(topic))
+        row[topic], row[answers.note_column(topic)] = codebook.encode(topic, answer)
+    for name in text_columns:
+        row[name] = text_value(name, values.get(name))
+    return row
+
+
+def existing_datetimes(con, user_id):
+    # A record at the same moment is taken as already imported
+    found = {row[0] for row in con.execute(
+        select(record_table.c.datetime).where(record_table.c.user_id == user_id))}
+    archived = retention.archived_rows(user_id, ['datetime'])
+    if archived is not None:
+        found.update(retention.as_datetime(row[0]) for row in archived)
+    return found
+
+
+def import_file(engine, user_id, user_name, fileobj, filename, progress=None):
+    # Validate and insert the records of an uploaded file in batches of
+    # batch_rows, each one transaction with its rollup increments.
+    # progress(imported) is called after every batch. Raises ValueError
+    # when the file cannot be read and nothing was imported; a file that
+    # breaks off later keeps the rows before the damage, and the summary
+    # gets the error. Invalid rows are skipped.
+    codebook = answers.codebook
+    summary = {'imported': 0, 'duplicates': 0, 'invalid': 0, 'own_answers': 0, 'errors': [], 'error': None}
+    with engine.connect() as con:
+        seen = existing_datetimes(con, user_id)
+    rows = read_rows(fileobj, filename)
+    error = None
+    while error is None:
+        chunk = []
+        try:
+            for item in islice(rows, batch_rows):
+                chunk.append(item)
+        except ValueError as e:
+            error = e
+        if not chunk and error is None:
+            break
+        batch = []
+        for number, values in chunk:
+            try:
+                row = make_row(user_id, user_name, values, codebook)
+            except ValueError as e:
+                summary['invalid'] += 1
+                if len(summary['errors']) < max_errors:
+                    summary['errors'].append('строка %d: %s' % (number, e))
+                continue
+            if row['datetime'] in seen:
+                summary['duplicates'] += 1
+                continue
+            seen.add(row['datetime'])
+            summary['own_answers'] += sum(row[topic] == answers.other_code for topic in answers.topics)
+            batch.append(row)
+        if batch:
+            with engine.begin() as con:
+                con.execute(record_table.insert(), batch)
+                stats.apply(con, stats.increments(batch))
+            summary['imported'] += len(batch)
+            if progress is not None:
+                progress(summary['imported'])
+    if error is not None:
+        if not summary['imported']:
+            raise error
+        summary['error'] = str(error)
+    return summary
+
+
+def format_summary(summary):
+    lines = ['Импортировано записей: %d' % summary['imported']]
+    if summary['error']:
+        lines.append('Файл прочитан не до конца: %s. Записи до этого места сохранены.' % summary['error'])
+    if summary['duplicates']:
+        lines.append('Пропущено как уже существующие (та же дата и время): %d' % summary['duplicates'])
+    if summary['own_answers']:
+        lines.append('Ответов не из кнопок, сохранены как свой вариант: %d' % summary['own_answers'])
+    if summary['invalid']:
+        lines.append('Пропущено строк с ошибками: %d' % summary['invalid'])
+        lines.extend(summary['errors'])
+    return '\n'.join(lines)
@@ -0,0 +1,244 @@
+import collections
+import logging
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from a fast handler to a large report
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def label_text(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                             for n, v in zip(names, values))
+
+
+class Histogram:
+    # Fixed buckets per label set; observe() is a bisect and three additions
+    # under a lock, cheap enough for every update
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.series = {} # label values -> [count per bucket and +Inf, count, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 2) + [0.0]
+            series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self):
+        with self.lock:
+            series = {k: list(v) for k, v in self.series.items()}
+        names = self.labels + ('le',)
+        for labels, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                yield self.name + '_bucket' + label_text(names, labels + (bound,)), cumulative
+            yield self.name + '_count' + label_text(self.labels, labels), values[-2]
+            yield self.name + '_sum' + label_text(self.labels, labels), values[-1]
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.series = collections.Counter()
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.series[labels] += amount
+
+    def samples(self):
+        with self.lock:
+            series = dict(self.series)
+        for labels, value in sorted(series.items()):
+            yield self.name + label_text(self.labels, labels), value
+
+
+class Gauge:
+    # Read from a callback at scrape time, e.g. a queue's current depth.
+    # kind='counter' exposes a running total kept elsewhere.
+    def __init__(self, name, help, read, kind='gauge'):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.kind = kind
+
+    def samples(self):
+        try:
+            yield self.name, self.read()
+        except Exception:
+            logger.exception('Failed to read gauge %s', self.name)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=default_buckets):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, read, kind='gauge'):
+        return self.add(Gauge(name, help, read, kind))
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, value in metric.samples():
+                lines.append('%s %s' % (name, repr(float(value)) if isinstance(value, float) else value))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+handler_seconds = registry.histogram(
+    'bot_handler_seconds', 'Time spent in conversation handlers', labels=('state',))
+stage_seconds = registry.histogram(
+    'bot_stage_seconds', 'Time spent in stages of record writes and reports', labels=('stage',))
+sessions = registry.counter(
+    'bot_sessions_total', 'Finished survey sessions', labels=('outcome',))
+reports = registry.counter(
+    'bot_reports_total', 'Report requests', labels=('outcome',))
+
+
+def timed_handler(state, callback):
+    @wraps(callback)
+    def wrapper(update, context):
+        with handler_seconds.time(state):
+            return callback(update, context)
+    return wrapper
+
+
+def instrument(handlers, state):
+    # Wrap handler callbacks in place so their time is recorded under state
+    for handler in handlers:
+        handler.callback = timed_handler(state, handler.callback)
+    return handlers
+
+
+def instrument_states(states, names):
+    # names maps a ConversationHandler state to its label
+    for state, handlers in states.items():
+        instrument(handlers, names.get(state, str(state)))
+    return states
+
+
+class SamplingProfiler:
+    # Samples the stacks of all threads every `interval` seconds and counts
+    # them in collapsed form ("outer;inner count" lines), the input format of
+    # flamegraph.pl and speedscope. Costs one sys._current_frames() per tick.
+    def __init__(self, interval=0.01, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.thread = None
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            tick = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append('%s:%s' % (code.co_filename.rsplit('/', 1)[-1], code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread'))
+                tick.append(';'.join(reversed(stack)))
+            with self.lock:
+                self.stacks.update(tick)
+                self.samples += 1
+
+    def collapsed(self):
+        with self.lock:
+            stacks = self.stacks.most_common()
+        return ''.join('%s %d\n' % item for item in stacks)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = registry
+    profiler = None
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = self.registry.render()
+        elif self.path == '/profile' and self.profiler is not None:
+            body = self.profiler.collapsed()
+        else:
+            self.send_error(404)
+            return
+        data = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host, port, profiler=None):
+    # /metrics for Prometheus, /profile for the sampler's collapsed stacks
+    handler = type('Handler', (MetricsHandler,), {'profiler': profiler})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
@@ -0,0 +1,124 @@
+from datetime import datetime
+
+from sqlalchemy import DateTime, inspect, text
+
+import models # bot's database model
+
+
+# Schema changes for databases created by older versions of the bot.
+# Each migration runs once, in order, and is recorded in schema_migrations.
+# Fresh databases get the same result from create_all, so migrations must
+# tolerate objects that already exist.
+
+def add_records_indexes(conn):
+    for index in models.Record.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+
+def records_coded(conn):
+    return 'emotions_note' in {c['name'] for c in inspect(conn).get_columns('records')}
+
+
+def backfill_user_aggregates(conn):
+    # Rollups of records still holding answer text are built by encode_answers
+    import stats # per-user rollups
+    if records_coded(conn):
+        stats.rebuild(conn)
+
+
+legacy_columns = ['id', 'user_id', 'user_name', 'datetime', 'emotions', 'energy', 'attention',
+    'conscientiousness', 'planning', 'stress', 'regime', 'body', 'reading', 'day_wish',
+    'day_accomplishment', 'comment', 'rating']
+convert_chunk = 10000
+
+
+def encode_answers(conn):
+    # Rewrite records from 'key: follow-up' strings to answer codes plus notes
+    import answers # answer codes
+    import stats # per-user rollups
+    models.AnswerOption.__table__.create(conn, checkfirst=True)
+    models.UserAggregate.__table__.create(conn, checkfirst=True)
+    codebook = answers.load(conn)
+    if records_coded(conn):
+        return
+    table = models.Record.__table__
+    for index in table.indexes:
+        conn.execute(text('DROP INDEX IF EXISTS %s' % index.name))
+    conn.execute(text('ALTER TABLE records RENAME TO records_legacy'))
+    table.create(conn)
+    result = conn.execution_options(stream_results=True).execute(text(
+        'SELECT %s FROM records_legacy ORDER BY id' % ', '.join(legacy_columns)).columns(datetime=DateTime))
+    while True:
+        rows = result.fetchmany(convert_chunk)
+        if not rows:
+            break
+        converted = []
+        for row in rows:
+            values = dict(row._mapping)
+            values.update(codebook.encode_values(values))
+            converted.append(values)
+        conn.execute(table.insert(), converted)
+    conn.execute(text('DROP TABLE records_legacy'))
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text("SELECT setval(pg_get_serial_sequence('records', 'id'), "
+                          "coalesce(max(id), 0) + 1, false) FROM records"))
+    stats.rebuild(conn)
+
+
+def autoincrement_record_ids(conn):
+    # Without AUTOINCREMENT SQLite hands out the ids of deleted rows again
+    # once the highest ones are gone, which archival does. /report new and
+    # the archive files rely on an id never coming back, so records is
+    # rebuilt and its sequence starts past every id seen so far, archived
+    # or exported. PostgreSQL sequences never go back already.
+    import retention # archived records
+    models.ExportMarker.__table__.create(conn, checkfirst=True)
+    if conn.dialect.name != 'sqlite':
+        return
+    table = models.Record.__table__
+    sql = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'records'")).scalar()
+    if 'AUTOINCREMENT' not in sql.upper():
+        columns = ', '.join(c.name for c in table.columns)
+        for index in table.indexes:
+            conn.execute(text('DROP INDEX IF EXISTS %s' % index.name))
+        conn.execute(text('ALTER TABLE records RENAME TO records_plain'))
+        table.create(conn)
+        conn.execute(text('INSERT INTO records (%s) SELECT %s FROM records_plain' % (columns, columns)))
+        conn.execute(text('DROP TABLE records_plain'))
+    seq = max(conn.execute(text("SELECT coalesce(max(seq), 0) FROM sqlite_sequence WHERE name = 'records'")).scalar(),
+              conn.execute(text('SELECT coalesce(max(id), 0) FROM records')).scalar(),
+              conn.execute(text('SELECT coalesce(max(last_record_id), 0) FROM export_markers')).scalar(),
+              retention.max_archived_id())
+    conn.execute(text("DELETE FROM sqlite_sequence WHERE name = 'records'"))
+    conn.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('records', :seq)"), {'seq': seq})
+
+
+migrations = [
+    (1, 'add records indexes', add_records_indexes),
+    (2, 'backfill user aggregates', backfill_user_aggregates),
+    (3, 'store answers as codes', encode_answers),
+    (4, 'never reuse record ids', autoincrement_record_ids),
+]
+
+
+def applied_versions(conn):
+    conn.execute(text('''CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name VARCHAR(100) NOT NULL,
+        applied_at TIMESTAMP NOT NULL)'''))
+    return {row[0] for row in conn.execute(text('SELECT version FROM schema_migrations'))}
+
+
+def run(engine, logger=None):
+    with engine.begin() as conn:
+        done = applied_versions(conn)
+    for version, name, migrate in migrations:
+        if version in done:
+            continue
+        if logger is not None:
+            logger.info('Applying migration %d: %s', version, name)
+        with engine.begin() as conn:
+            migrate(conn)
+            conn.execute(text('INSERT INTO schema_migrations (version, name, applied_at) '
+                              'VALUES (:version, :name, :applied_at)'),
+                         {'version': version, 'name': name, 'applied_at': datetime.now()})
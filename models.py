@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Sequence, DateTime
+from sqlalchemy import Column, Integer, BigInteger, SmallInteger, String, Sequence, DateTime, Index, Text, Boolean
 from sqlalchemy.ext.declarative import declarative_base
 
 
@@ -19,18 +19,33 @@ class User(Base):
 
 class Record(Base):
     __tablename__ = 'records'
+    __table_args__ = (
+        Index('ix_records_user_id_datetime', 'user_id', 'datetime'),
+        Index('ix_records_user_name', 'user_name'),
+        # ids of archived rows must never be handed out again, see migrations
+        {'sqlite_autoincrement': True},
+    )
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer)
+    user_id = Column(BigInteger)
     user_name = Column(String(50),nullable=False)
     datetime = Column(DateTime, nullable=False)
-    emotions = Column(String(500))
-    energy = Column(String(500))
-    attention = Column(String(500))
-    conscientiousness = Column(String(500))
-    planning = Column(String(500))
-    stress = Column(String(500))
-    regime = Column(String(500))
-    body = Column(String(500))
+    # Keyboard answers: a code from answer_options and the follow-up text
+    emotions = Column(SmallInteger)
+    emotions_note = Column(String(500))
+    energy = Column(SmallInteger)
+    energy_note = Column(String(500))
+    attention = Column(SmallInteger)
+    attention_note = Column(String(500))
+    conscientiousness = Column(SmallInteger)
+    conscientiousness_note = Column(String(500))
+    planning = Column(SmallInteger)
+    planning_note = Column(String(500))
+    stress = Column(SmallInteger)
+    stress_note = Column(String(500))
+    regime = Column(SmallInteger)
+    regime_note = Column(String(500))
+    body = Column(SmallInteger)
+    body_note = Column(String(500))
     reading = Column(String(500))
     day_wish = Column(String(500))
     day_accomplishment = Column(String(500))
@@ -40,3 +55,70 @@ class Record(Base):
     def __repr__(self):
         return "<Record(user_id='%s', user_name='%s', datetime='%s')>" % (                   self.user_id, self.user_name, self.datetime, self.nickname)
 
+
+
+class AnswerOption(Base):
+    # Codes of keyboard answers stored in records; code 0 is free text
+    __tablename__ = 'answer_options'
+    topic = Column(String(50), primary_key=True)
+    code = Column(SmallInteger, primary_key=True)
+    label = Column(String(500), nullable=False)
+
+    def __repr__(self):
+        return "<AnswerOption(topic='%s', code='%s', label='%s')>" % (
+                                self.topic, self.code, self.label)
+
+
+class ExportMarker(Base):
+    # Newest record a user has received in a report, for /report new
+    __tablename__ = 'export_markers'
+    user_id = Column(BigInteger, primary_key=True)
+    last_record_id = Column(Integer, nullable=False)
+    exported_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return "<ExportMarker(user_id='%s', last_record_id='%s')>" % (
+                                self.user_id, self.last_record_id)
+
+
+class PersistentState(Base):
+    # Conversation states and user_data of in-flight surveys
+    __tablename__ = 'persistent_state'
+    kind = Column(String(20), primary_key=True)
+    name = Column(String(50), primary_key=True)
+    key = Column(String(100), primary_key=True)
+    value = Column(Text, nullable=False)
+
+    def __repr__(self):
+        return "<PersistentState(kind='%s', name='%s', key='%s')>" % (
+                                self.kind, self.name, self.key)
+
+
+class UserAggregate(Base):
+    # Per-user rollup counters kept up to date as records are written.
+    # kind is 'total', 'day', 'week', 'month', 'rating' or 'topic:<name>'
+    __tablename__ = 'user_aggregates'
+    user_id = Column(BigInteger, primary_key=True)
+    kind = Column(String(50), primary_key=True)
+    key = Column(String(200), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<UserAggregate(user_id='%s', kind='%s', key='%s', count='%s')>" % (
+                                self.user_id, self.kind, self.key, self.count)
+
+
+class Reminder(Base):
+    # Daily check-in reminder; times are minutes after local midnight
+    __tablename__ = 'reminders'
+    user_id = Column(BigInteger, primary_key=True)
+    chat_id = Column(BigInteger, nullable=False)
+    minute = Column(Integer, nullable=False)
+    tz = Column(String(50), nullable=False, default='UTC')
+    quiet_start = Column(Integer)
+    quiet_end = Column(Integer)
+    enabled = Column(Boolean, nullable=False, default=True)
+
+    def __repr__(self):
+        return "<Reminder(user_id='%s', minute='%s', tz='%s')>" % (
+                                self.user_id, self.minute, self.tz)
@@ -0,0 +1,225 @@
+import asyncio
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+
+from telegram import Bot
+from telegram.error import RetryAfter
+
+
+logger = logging.getLogger(__name__)
+
+# Lower values are sent first when chats compete for the global rate
+PRIORITY_SURVEY = 0
+PRIORITY_UPLOAD = 2
+
+
+class TokenBucket:
+    # reserve() takes a token and returns how long to wait before using it;
+    # tokens may go negative so that waiting callers queue up fairly
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now=None):
+        self.refill(time.monotonic() if now is None else now)
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def full(self, now):
+        self.refill(now)
+        return self.tokens >= self.burst
+
+
+class Job:
+    __slots__ = ('call', 'future', 'priority', 'attempts')
+
+    def __init__(self, call, future, priority):
+        self.call = call
+        self.future = future
+        self.priority = priority
+        self.attempts = 0
+
+
+class ChatQueue:
+    __slots__ = ('jobs', 'bucket', 'scheduled')
+
+    def __init__(self, bucket):
+        self.jobs = deque()
+        self.bucket = bucket
+        self.scheduled = False # waiting for its bucket, in the ready queue or being sent
+
+
+class Outbox:
+    # Outbound Bot API calls run on an asyncio loop in a background thread.
+    # Each chat sends one message at a time, in order, limited by its own
+    # token bucket; chats whose next message is due wait in a priority queue
+    # and `connections` sender tasks take them under a global token bucket.
+    # The blocking HTTP calls share a fixed pool of `connections` threads,
+    # so in-flight replies cost a queue entry, not a thread. A 429 from
+    # Telegram delays that chat for the requested retry_after.
+    def __init__(self, connections=8, global_rate=30, chat_rate=1, chat_burst=3, max_retries=3):
+        self.connections = connections
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=connections, thread_name_prefix='outbox')
+        self.chats = {} # chat_id -> ChatQueue, only touched on the loop
+        self.ready = None
+        self.senders = []
+        self.order = itertools.count()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.metrics = {'sent': 0, 'failed': 0, 'retried': 0, 'throttled_seconds': 0.0}
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.loop.run_forever, name='outbox', daemon=True)
+                self.thread.start()
+                self.loop.call_soon_threadsafe(self.setup)
+
+    def setup(self):
+        self.ready = asyncio.PriorityQueue()
+        self.senders = [self.loop.create_task(self.sender()) for _ in range(self.connections)]
+        self.loop.call_later(60, self.sweep)
+
+    def submit(self, chat_id, fn, *args, priority=PRIORITY_SURVEY, **kwargs):
+        # Returns a concurrent future; asyncio code can await it through asyncio.wrap_future
+        self.start()
+        future = Future()
+        self.loop.call_soon_threadsafe(self.enqueue, chat_id, Job(partial(fn, *args, **kwargs), future, priority))
+        return future
+
+    def enqueue(self, chat_id, job):
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = ChatQueue(TokenBucket(self.chat_rate, self.chat_burst))
+        chat.jobs.append(job)
+        if not chat.scheduled:
+            self.schedule(chat_id, chat, chat.bucket.reserve())
+
+    def schedule(self, chat_id, chat, delay):
+        chat.scheduled = True
+        if delay > 0:
+            self.metrics['throttled_seconds'] += delay
+            self.loop.call_later(delay, self.make_ready, chat_id, chat)
+        else:
+            self.make_ready(chat_id, chat)
+
+    def make_ready(self, chat_id, chat):
+        self.ready.put_nowait((chat.jobs[0].priority, next(self.order), chat_id))
+
+    async def sender(self):
+        while True:
+            _, _, chat_id = await self.ready.get()
+            chat = self.chats[chat_id]
+            job = chat.jobs[0]
+            delay = self.global_bucket.reserve()
+            if delay > 0:
+                self.metrics['throttled_seconds'] += delay
+                await asyncio.sleep(delay)
+            try:
+                result = await self.loop.run_in_executor(self.executor, job.call)
+            except RetryAfter as e:
+                job.attempts += 1
+                if job.attempts <= self.max_retries:
+                    self.metrics['retried'] += 1
+                    logger.warning('Flood limit for chat %s, retrying in %ss', chat_id, e.retry_after)
+                    self.schedule(chat_id, chat, e.retry_after)
+                    continue
+                self.finish(chat_id, chat, job, error=e)
+            except Exception as e:
+                self.finish(chat_id, chat, job, error=e)
+            else:
+                self.finish(chat_id, chat, job, result=result)
+
+    def finish(self, chat_id, chat, job, result=None, error=None):
+        chat.jobs.popleft()
+        if error is None:
+            self.metrics['sent'] += 1
+            job.future.set_result(result)
+        else:
+            self.metrics['failed'] += 1
+            logger.warning('Send to chat %s failed: %s', chat_id, error)
+            job.future.set_exception(error)
+        if chat.jobs:
+            self.schedule(chat_id, chat, chat.bucket.reserve())
+        else:
+            chat.scheduled = False
+
+    def sweep(self):
+        # Forget idle chats once their bucket has refilled
+        now = time.monotonic()
+        for chat_id in [k for k, chat in self.chats.items()
+                        if not chat.scheduled and not chat.jobs and chat.bucket.full(now)]:
+            del self.chats[chat_id]
+        self.loop.call_later(60, self.sweep)
+
+    def pending(self):
+        return sum(len(chat.jobs) for chat in list(self.chats.values()))
+
+    def stats(self):
+        stats = dict(self.metrics)
+        stats['queue_depth'] = self.pending()
+        stats['chats'] = len(self.chats)
+        return stats
+
+    async def wait_empty(self):
+        while any(chat.jobs for chat in self.chats.values()):
+            await asyncio.sleep(0.05)
+
+    async def stop_senders(self):
+        for task in self.senders:
+            task.cancel()
+        await asyncio.gather(*self.senders, return_exceptions=True)
+
+    def close(self, timeout=10):
+        if self.thread is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self.wait_empty(), self.loop).result(timeout)
+        except Exception:
+            logger.warning('Outbox closed with %d unsent messages', self.pending())
+        asyncio.run_coroutine_threadsafe(self.stop_senders(), self.loop).result(timeout)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
+        self.executor.shutdown(wait=False)
+
+
+def wait_sent(result, timeout=None):
+    # Block until a queued send went out; plain Bot results pass through
+    return result.result(timeout) if isinstance(result, Future) else result
+
+
+class QueuedBot(Bot):
+    # Bot whose send methods go through an Outbox and return futures,
+    # so handlers keep calling reply_text/send_document as before.
+    # Survey prompts are sent ahead of report uploads.
+    def __init__(self, *args, outbox=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._outbox = outbox
+
+    def send_message(self, chat_id, *args, **kwargs):
+        return self._outbox.submit(chat_id, super().send_message, chat_id, *args,
+                                   priority=PRIORITY_SURVEY, **kwargs)
+
+    def send_document(self, chat_id, *args, **kwargs):
+        return self._outbox.submit(chat_id, super().send_document, chat_id, *args,
+                                   priority=PRIORITY_UPLOAD, **kwargs)
+
+    def send_photo(self, chat_id, *args, **kwargs):
+        return self._outbox.submit(chat_id, super().send_photo, chat_id, *args,
+                                   priority=PRIORITY_UPLOAD, **kwargs)
@@ -0,0 +1,101 @@
+import json
+import logging
+import threading
+from collections import defaultdict
+
+from sqlalchemy import bindparam, delete, insert, select
+from telegram.ext import BasePersistence
+
+import models # bot's database model
+
+
+logger = logging.getLogger(__name__)
+
+state_table = models.PersistentState.__table__
+
+
+def dump(value):
+    return json.dumps(value, ensure_ascii=False, sort_keys=True)
+
+
+class SQLPersistence(BasePersistence):
+    # Keeps conversation states and user_data in the persistent_state table.
+    # Updates only mark changed keys as dirty; flush() writes them in one
+    # transaction and is called on an interval and on shutdown, so the
+    # message handlers never wait on the disk.
+    def __init__(self, engine):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.engine = engine
+        self.lock = threading.Lock()
+        self.saved = {} # (kind, name, key) -> value last written
+        self.dirty = {} # (kind, name, key) -> value to write, None to delete
+
+    def load(self, kind, name=''):
+        with self.engine.connect() as conn:
+            rows = conn.execute(select(state_table.c.key, state_table.c.value).where(
+                state_table.c.kind == kind, state_table.c.name == name)).fetchall()
+        for key, value in rows:
+            self.saved[(kind, name, key)] = value
+        return rows
+
+    def mark(self, ident, value):
+        with self.lock:
+            if self.dirty.get(ident, self.saved.get(ident)) != value:
+                self.dirty[ident] = value
+
+    def get_user_data(self):
+        user_data = defaultdict(dict)
+        for key, value in self.load('user_data'):
+            user_data[int(key)] = json.loads(value)
+        return user_data
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        return {tuple(json.loads(key)): json.loads(value) for key, value in self.load('conversation', name)}
+
+    def update_conversation(self, name, key, new_state):
+        self.mark(('conversation', name, dump(list(key))), None if new_state is None else dump(new_state))
+
+    def update_user_data(self, user_id, data):
+        self.mark(('user_data', '', str(user_id)), dump(data) if data else None)
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+    def flush(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+        if not dirty:
+            return
+        idents = [{'b_kind': k, 'b_name': n, 'b_key': key} for k, n, key in dirty]
+        rows = [{'kind': k, 'name': n, 'key': key, 'value': value}
+                for (k, n, key), value in dirty.items() if value is not None]
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(delete(state_table).where(
+                    state_table.c.kind == bindparam('b_kind'),
+                    state_table.c.name == bindparam('b_name'),
+                    state_table.c.key == bindparam('b_key')), idents)
+                if rows:
+                    conn.execute(insert(state_table), rows)
+        except Exception:
+            logger.exception('Failed to flush %d persisted keys', len(dirty))
+            with self.lock:
+                # Keep the failed keys unless they changed again meanwhile
+                for ident, value in dirty.items():
+                    self.dirty.setdefault(ident, value)
+            return
+        with self.lock:
+            for ident, value in dirty.items():
+                if value is None:
+                    self.saved.pop(ident, None)
+                else:
+                    self.saved[ident] = value
@@ -0,0 +1,57 @@
+import report # report periods
+import retention # archived records
+
+
+max_points = 120 # longer histories are averaged per week or month
+
+
+def load_ratings(con, user_id, period=None):
+    # pandas is heavy and only needed for plots, so it is imported on first use
+    import pandas as pd
+    query, params = report.record_query('''SELECT datetime, rating
+    FROM records WHERE user_id = :user_id%s ORDER BY datetime''', period or report.Period())
+    params['user_id'] = user_id
+    data = pd.read_sql_query(query, con, params=params, parse_dates=['datetime'])
+    data = retention.with_archived(data, user_id, ['datetime', 'rating'], period)
+    return data.set_index('datetime')['rating'].dropna()
+
+
+def resample(ratings):
+    # Daily, weekly or monthly means, whichever keeps the plot under max_points
+    if ratings.empty:
+        return ratings, 'D'
+    days = (ratings.index.max() - ratings.index.min()).days + 1
+    if days <= max_points:
+        rule = 'D'
+    elif days <= max_points * 7:
+        rule = 'W'
+    else:
+        rule = 'MS'
+    return ratings.resample(rule).mean().dropna(), rule
+
+
+def render_plot(ratings, target):
+    # Object-oriented Figure on the Agg canvas: no pyplot global state,
+    # so it is safe to call from report pool threads
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    import matplotlib.dates as mdates
+
+    points, rule = resample(ratings)
+    fig = Figure(figsize=(10, 3))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.set_facecolor('#E5E5E5')
+    ax.grid(color='white')
+    ax.plot(points.index, points.values, marker='o' if len(points) < 40 else None)
+    locator = mdates.AutoDateLocator(maxticks=12)
+    ax.xaxis.set_major_locator(locator)
+    ax.xaxis.set_major_formatter(mdates.ConciseDateFormatter(locator))
+    ax.set_ylim(-0.1, 2.1)
+    ax.set_yticks([0, 1, 2])
+    ax.set_title('График продуктивности' + {'D': '', 'W': ' (среднее за неделю)',
+                                            'MS': ' (среднее за месяц)'}[rule])
+    ax.set_ylabel('Продуктивность')
+    ax.set_xlabel('Дата')
+    fig.tight_layout()
+    fig.savefig(target, format='png', dpi=100)
@@ -230,4 +230,10 @@ help_text ='''Бот позволяет вести ежедневник, в ко
 
 Нажмите /start_session и бот опросит вас по этим пунктам.
 
-Для того, чтобы получить отчет по вашим записям, нажмите /report.'''
+Для того, чтобы получить отчет по вашим записям, нажмите /report.
+Другие форматы: /report csv, /report json, /report parquet.
+За период: /report week, /report month, /report 2024-05, только новые записи: /report new.
+Краткая статистика по записям: /stats.
+Тренды оценок и их связь с ответами: /trends.
+Загрузить прошлые записи из xlsx или csv: /import.
+Ежедневное напоминание: /remind.'''
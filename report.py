@@ -0,0 +1,248 @@
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+from datetime import datetime, timedelta
+
+from sqlalchemy import DateTime, bindparam, case, text
+
+import answers # answer codes
+import models # bot's database model
+import retention # archived records
+
+
+report_columns = ['datetime', 'emotions', 'energy', 'attention', 'conscientiousness',
+    'planning', 'stress', 'regime', 'body', 'reading', 'day_wish',
+    'day_accomplishment', 'comment', 'rating']
+
+chunk_size = 500 # rows fetched from the database per round trip
+
+
+def column_width(index):
+    return 15 if index == 0 else 30
+
+
+class Period:
+    # Which of a user's records a report covers: datetime in [start, end)
+    # and, for incremental reports, id above after_id. since_last is
+    # resolved to after_id from the user's export marker.
+    def __init__(self, start=None, end=None, after_id=None, since_last=False):
+        self.start = start
+        self.end = end
+        self.after_id = after_id
+        self.since_last = since_last
+
+    def restricted(self):
+        return self.start is not None or self.end is not None or self.after_id is not None
+
+    def where(self):
+        # SQL conditions after user_id and their parameters; all of them
+        # are ranges on the (user_id, datetime) index or its rowid
+        clauses, params = [], {}
+        if self.start is not None:
+            clauses.append('datetime >= :start')
+            params['start'] = self.start
+        if self.end is not None:
+            clauses.append('datetime < :end')
+            params['end'] = self.end
+        if self.after_id is not None:
+            clauses.append('id > :after_id')
+            params['after_id'] = self.after_id
+        return ''.join(' AND ' + c for c in clauses), params
+
+    def tag(self):
+        # Part of the report cache key
+        tag = ''
+        if self.start is not None:
+            tag += 'f' + self.start.strftime('%Y%m%d')
+        if self.end is not None:
+            tag += 't' + self.end.strftime('%Y%m%d')
+        if self.after_id is not None:
+            tag += 'a%d' % self.after_id
+        return tag
+
+
+def month_start(day):
+    return day.replace(day=1)
+
+
+def next_month(day):
+    return (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d')
+
+
+def parse_period(token, now=None):
+    # all, new, week, month, <N>d, YYYY-MM, YYYY-MM-DD, YYYY-MM-DD..YYYY-MM-DD
+    # (either side of '..' may be left out); dates are inclusive.
+    # Raises ValueError for anything else.
+    now = now or datetime.now()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    token = token.lower()
+    if token == 'all':
+        return Period()
+    if token == 'new':
+        return Period(since_last=True)
+    if token == 'week':
+        return Period(start=today - timedelta(days=6))
+    if token == 'month':
+        return Period(start=month_start(today))
+    days = re.fullmatch(r'(\d+)d', token)
+    if days:
+        return Period(start=today - timedelta(days=int(days.group(1)) - 1))
+    if re.fullmatch(r'\d{4}-\d{2}', token):
+        start = datetime.strptime(token, '%Y-%m')
+        return Period(start=start, end=next_month(start))
+    if '..' in token:
+        first, last = token.split('..', 1)
+        if not first and not last:
+            raise ValueError(token)
+        return Period(start=parse_date(first) if first else None,
+                      end=parse_date(last) + timedelta(days=1) if last else None)
+    day = parse_date(token)
+    return Period(start=day, end=day + timedelta(days=1))
+
+
+def record_query(sql, period):
+    where, params = period.where()
+    query = text(sql % where)
+    if 'start' in params:
+        query = query.bindparams(bindparam('start', type_=DateTime))
+    if 'end' in params:
+        query = query.bindparams(bindparam('end', type_=DateTime))
+    return query, params
+
+
+def iter_records(con, user_id, size=chunk_size, period=None):
+    # Yield rows one chunk at a time so memory does not grow with the history.
+    # Served by the (user_id, datetime) index, which also bounds a period's
+    # scan to the rows it covers. Archived records are merged in, and
+    # answer codes are turned back into the text the user chose.
+    period = period or Period()
+    decode = answers.codebook.decoder(report_columns)
+    columns = ['id'] + answers.columns(report_columns)
+    query, params = record_query('SELECT %s FROM records WHERE user_id = :user_id%%s ORDER BY datetime, id'
+                                 % ', '.join(columns), period)
+    params['user_id'] = user_id
+    result = con.execution_options(stream_results=True).execute(query, params)
+
+    def live():
+        while True:
+            rows = result.fetchmany(size)
+            if not rows:
+                break
+            yield from rows
+
+    try:
+        for row in retention.merged(live(), user_id, columns, period):
+            yield decode(row[1:])
+    finally:
+        result.close()
+
+
+def last_record_id(con, user_id):
+    # Archived ids count too: imported history is archived first
+    live = con.execute(text('SELECT max(id) FROM records WHERE user_id = :user_id'),
+                       {'user_id': user_id}).scalar() or 0
+    return max(live, retention.max_archived_id(user_id))
+
+
+def has_records(con, user_id, period):
+    query, params = record_query('SELECT 1 FROM records WHERE user_id = :user_id%s LIMIT 1', period)
+    params['user_id'] = user_id
+    return con.execute(query, params).first() is not None or retention.has_archived(user_id, period)
+
+
+marker_table = models.ExportMarker.__table__
+
+
+def exported_up_to(con, user_id):
+    # id of the newest record in the user's last report, 0 before the first
+    return con.execute(text('SELECT last_record_id FROM export_markers WHERE user_id = :user_id'),
+                       {'user_id': user_id}).scalar() or 0
+
+
+def mark_exported(con, user_id, record_id):
+    if con.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    stmt = insert(marker_table).values(user_id=user_id, last_record_id=record_id, exported_at=datetime.now())
+    # the marker only moves forward
+    con.execute(stmt.on_conflict_do_update(
+        index_elements=['user_id'],
+        set_={'last_record_id': case((stmt.excluded.last_record_id > marker_table.c.last_record_id,
+                                      stmt.excluded.last_record_id), else_=marker_table.c.last_record_id),
+              'exported_at': stmt.excluded.exported_at}))
+
+
+def styled_row(worksheet, values, template, make_cell):
+    # Copy a prepared style array instead of re-resolving the Alignment per cell
+    row = []
+    for value in values:
+        cell = make_cell(worksheet, value=value)
+        cell._style = copy(template._style)
+        row.append(cell)
+    return row
+
+
+def build_report(rows, target):
+    # target is a file path or a writable binary file object.
+    # openpyxl is imported on first use to keep bot start-up light.
+    import openpyxl
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Alignment, Font
+    cell_alignment = Alignment(wrap_text=True, vertical='top')
+    wb = openpyxl.Workbook(write_only=True)
+    worksheet = wb.create_sheet()
+    # column widths must be set before the first row is written
+    for i in range(len(report_columns)):
+        letter = openpyxl.utils.get_column_letter(i + 1)
+        worksheet.column_dimensions[letter].width = column_width(i)
+    header = WriteOnlyCell(worksheet)
+    header.alignment = cell_alignment
+    header.font = Font(bold=True)
+    body = WriteOnlyCell(worksheet)
+    body.alignment = cell_alignment
+    worksheet.append(styled_row(worksheet, report_columns, header, WriteOnlyCell))
+    for values in rows:
+        worksheet.append(styled_row(worksheet, values, body, WriteOnlyCell))
+    wb.save(target)
+
+
+class ReportPool:
+    # Bounded pool that builds reports off the dispatcher threads.
+    # At most max_pending jobs are queued or running; submit() returns None
+    # instead of queueing more.
+    def __init__(self, workers=2, max_pending=8):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='report')
+        self.max_pending = max_pending
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.pending = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            return None
+        with self.lock:
+            self.pending += 1
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self.release()
+            raise
+        future.add_done_callback(lambda f: self.release())
+        return future
+
+    def release(self):
+        with self.lock:
+            self.pending -= 1
+        self.slots.release()
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,112 @@
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+
+class CacheEntry:
+    def __init__(self, path, size, file_id=None):
+        self.path = path
+        self.size = size
+        self.file_id = file_id # Telegram file_id of an earlier upload
+
+
+class ReportCache:
+    # Built reports on disk, keyed by (user_id, last record id, format).
+    # Least recently used files are evicted once the directory holds more
+    # than max_bytes. A new record only invalidates its own user's entries.
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.scan()
+
+    def scan(self):
+        # Reuse files left by a previous run, oldest first
+        found = []
+        for name in os.listdir(self.directory):
+            key = self.parse(name)
+            if key is None:
+                continue
+            path = os.path.join(self.directory, name)
+            stat = os.stat(path)
+            found.append((stat.st_mtime, key, path, stat.st_size))
+        for _, key, path, size in sorted(found):
+            self.entries[key] = CacheEntry(path, size)
+            self.size += size
+        self.evict()
+
+    @staticmethod
+    def filename(key):
+        return '%d-%d.%s' % key
+
+    @staticmethod
+    def parse(name):
+        try:
+            stem, fmt = name.split('.', 1)
+            user_id, last_id = stem.split('-')
+            return int(user_id), int(last_id), fmt
+        except ValueError:
+            return None
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, build):
+        # build(fileobj) writes the report; it is moved into place when complete
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                build(f)
+            path = os.path.join(self.directory, self.filename(key))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        entry = CacheEntry(path, os.path.getsize(path))
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            self.entries[key] = entry
+            self.size += entry.size
+            self.evict(keep=key)
+        return entry
+
+    def set_file_id(self, key, file_id):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry.file_id = file_id
+
+    def invalidate(self, user_id):
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == user_id]:
+                self.remove(key)
+
+    def evict(self, keep=None):
+        # Called with the lock held
+        for key in list(self.entries):
+            if self.size <= self.max_bytes:
+                break
+            if key != keep:
+                self.remove(key)
+
+    def remove(self, key):
+        entry = self.entries.pop(key)
+        self.size -= entry.size
+        try:
+            os.unlink(entry.path)
+        except OSError:
+            logger.warning('Could not remove cached report %s', entry.path)
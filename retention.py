@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Retention of old records: archival to compressed per-user monthly files
+# that reports still read, and compaction of the database.
+# Run by hand with: python retention.py archive [--days N]
+#                   python retention.py vacuum [--full]
+#                   python retention.py sizes
+
+import argparse
+import gzip
+import heapq
+import json
+import logging
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, text
+from sqlalchemy.exc import OperationalError
+
+import db # engine and data directory
+import metrics # latency histograms
+import models # bot's database model
+
+
+logger = logging.getLogger(__name__)
+
+record_table = models.Record.__table__
+
+# Records older than RETENTION_DAYS move from the database to
+# ARCHIVE_DIR/<user_id>/<YYYY-MM>.jsonl.gz; 0 keeps everything in the database
+retention_days = int(os.environ.get('RETENTION_DAYS', 0))
+archive_dir = os.environ.get('ARCHIVE_DIR', os.path.join(db.data_dir, 'archive'))
+archive_columns = [c.name for c in record_table.columns if c.name != 'user_id']
+time_format = '%Y-%m-%d %H:%M:%S.%f' # as SQLite stores DateTime
+delete_batch = 500
+# Free pages returned to the file system per maintenance run
+vacuum_pages = int(os.environ.get('VACUUM_PAGES', 10000))
+analysis_limit = 1000 # rows ANALYZE samples per index
+
+
+def month_key(dt):
+    return dt.strftime('%Y-%m')
+
+
+def archive_path(user_id, month):
+    return os.path.join(archive_dir, str(user_id), month + '.jsonl.gz')
+
+
+def as_datetime(value):
+    return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+
+
+def read_archive(path, columns):
+    # Rows of one archive file with the given columns; a header line names
+    # the stored columns, so files outlive schema changes
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        stored = json.loads(f.readline())
+        picks = [stored.index(c) if c in stored else None for c in columns]
+        for line in f:
+            row = json.loads(line)
+            yield [row[i] if i is not None else None for i in picks]
+
+
+def write_archive(path, rows):
+    # Written next to path and moved into place once it is on disk
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=9, mtime=0) as f:
+                f.write((json.dumps(archive_columns) + '\n').encode('utf-8'))
+                for row in rows:
+                    f.write((json.dumps(row, ensure_ascii=False) + '\n').encode('utf-8'))
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def archive_user(engine, user_id, cutoff):
+    # Move one user's records older than cutoff into their monthly files.
+    # Files are written before the rows are deleted; a crash in between
+    # leaves rows in both places until the next run, and readers skip the
+    # duplicates.
+    with engine.connect() as con:
+        rows = con.execute(select(*[record_table.c[c] for c in archive_columns])
+                           .where(record_table.c.user_id == user_id)
+                           .where(record_table.c.datetime < cutoff)).fetchall()
+    id_index, time_index = archive_columns.index('id'), archive_columns.index('datetime')
+    months = {}
+    for row in rows:
+        values = list(row)
+        values[time_index] = row.datetime.strftime(time_format)
+        months.setdefault(month_key(row.datetime), []).append(values)
+    for month, new in months.items():
+        path = archive_path(user_id, month)
+        merged = {}
+        if os.path.exists(path):
+            merged.update((row[id_index], row) for row in read_archive(path, archive_columns))
+        merged.update((row[id_index], row) for row in new)
+        write_archive(path, sorted(merged.values(), key=lambda row: (row[time_index], row[id_index])))
+    ids = [row.id for row in rows]
+    with engine.begin() as con:
+        for i in range(0, len(ids), delete_batch):
+            con.execute(record_table.delete().where(record_table.c.id.in_(ids[i:i + delete_batch])))
+    return len(ids)
+
+
+def archive(engine, days=None, now=None):
+    # -> (users, records) moved out of the database
+    days = retention_days if days is None else days
+    cutoff = (now or datetime.now()) - timedelta(days=days)
+    with engine.connect() as con:
+        users = [row[0] for row in con.execute(
+            select(record_table.c.user_id).where(record_table.c.datetime < cutoff).distinct())]
+    moved = sum(archive_user(engine, user_id, cutoff) for user_id in users)
+    return len(users), moved
+
+
+def archived_users():
+    try:
+        return sorted(int(name) for name in os.listdir(archive_dir) if name.lstrip('-').isdigit())
+    except FileNotFoundError:
+        return []
+
+
+archived_id_cache = {} # user_id -> (directory mtime, highest archived id)
+
+
+def max_archived_id(user_id=None):
+    # Highest record id in the archive files of one user, or of everyone.
+    # Per user it is cached until a file in their directory is replaced.
+    if user_id is None:
+        return max([0] + [max_archived_id(user) for user in archived_users()])
+    directory = os.path.join(archive_dir, str(user_id))
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+    cached = archived_id_cache.get(user_id)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    highest = 0
+    for name in os.listdir(directory):
+        if name.endswith('.jsonl.gz'):
+            highest = max([highest] + [row[0] for row in read_archive(os.path.join(directory, name), ['id'])])
+    archived_id_cache[user_id] = (mtime, highest)
+    return highest
+
+
+def archived_rows(user_id, columns, period=None):
+    # Archived rows with the given columns in datetime order, limited to a
+    # report period; None when the user has nothing archived
+    directory = os.path.join(archive_dir, str(user_id))
+    try:
+        months = sorted(name[:-len('.jsonl.gz')] for name in os.listdir(directory) if name.endswith('.jsonl.gz'))
+    except FileNotFoundError:
+        return None
+    start = end = after_id = None
+    if period is not None:
+        start, end, after_id = period.start, period.end, period.after_id
+    if start is not None:
+        months = [m for m in months if m >= month_key(start)]
+    if end is not None:
+        months = [m for m in months if m <= month_key(end - timedelta(microseconds=1))]
+    if not months:
+        return None
+    time_index = columns.index('datetime')
+    id_index = columns.index('id') if 'id' in columns else None
+    picked = columns if id_index is not None or after_id is None else columns + ['id']
+
+    def rows():
+        for month in months:
+            for row in read_archive(archive_path(user_id, month), picked):
+                dt = as_datetime(row[time_index])
+                if (start is not None and dt < start) or (end is not None and dt >= end):
+                    continue
+                if after_id is not None and row[picked.index('id')] <= after_id:
+                    continue
+                yield row[:len(columns)]
+    return rows()
+
+
+def has_archived(user_id, period=None):
+    rows = archived_rows(user_id, ['datetime'], period)
+    return rows is not None and next(rows, None) is not None
+
+
+def merged(rows, user_id, columns, period=None):
+    # Live rows merged with archived ones in (datetime, id) order. columns
+    # start with id and datetime, and rows come sorted the same way.
+    archived = archived_rows(user_id, columns, period)
+    if archived is None:
+        yield from rows
+        return
+    last_id = None
+    for row in heapq.merge(archived, rows, key=lambda row: (as_datetime(row[1]), row[0])):
+        if row[0] != last_id:
+            yield row
+        last_id = row[0]
+
+
+def with_archived(frame, user_id, columns, period=None):
+    # A user's live records as a DataFrame, with their archived ones added
+    import pandas as pd
+    archived = archived_rows(user_id, columns, period)
+    if archived is None:
+        return frame
+    archived = pd.DataFrame(list(archived), columns=columns)
+    if archived.empty:
+        return frame
+    archived['datetime'] = pd.to_datetime(archived['datetime'], format='ISO8601')
+    return pd.concat([archived, frame], ignore_index=True).sort_values('datetime', kind='stable', ignore_index=True)
+
+
+def vacuum(engine, pages=None, full=False):
+    # SQLite: return up to `pages` free pages to the file system, refresh the
+    # planner statistics and truncate the WAL. A database created before
+    # incremental auto_vacuum was enabled needs one full VACUUM to switch.
+    # PostgreSQL: VACUUM ANALYZE.
+    pages = vacuum_pages if pages is None else pages
+    with engine.connect() as con:
+        con = con.execution_options(isolation_level='AUTOCOMMIT')
+        if con.dialect.name != 'sqlite':
+            con.exec_driver_sql('VACUUM FULL ANALYZE' if full else 'VACUUM ANALYZE')
+            return
+        if full:
+            con.exec_driver_sql('PRAGMA auto_vacuum=INCREMENTAL')
+            con.exec_driver_sql('VACUUM')
+        elif con.exec_driver_sql('PRAGMA auto_vacuum').scalar() == 2:
+            # sqlite3 steps a statement without result rows only once, which
+            # frees a single page; executescript runs it to the end
+            con.connection.driver_connection.executescript('PRAGMA incremental_vacuum(%d)' % pages)
+        else:
+            logger.info('Incremental vacuum is off for this database, '
+                        'run python retention.py vacuum --full once to enable it')
+        con.exec_driver_sql('PRAGMA analysis_limit=%d' % analysis_limit)
+        con.exec_driver_sql('ANALYZE')
+        con.exec_driver_sql('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+
+
+def maintain(engine):
+    # Scheduled daily by the bot
+    if retention_days > 0:
+        with metrics.stage_seconds.time('archive'):
+            users, moved = archive(engine)
+        logger.info('Archived %d records of %d users', moved, users)
+    with metrics.stage_seconds.time('vacuum'):
+        vacuum(engine)
+
+
+def sizes(con):
+    # [(table, bytes, [(index, bytes)])], largest first
+    if con.dialect.name == 'sqlite':
+        try:
+            pages = dict(con.execute(text('SELECT name, sum(pgsize) FROM dbstat GROUP BY name')).fetchall())
+        except OperationalError:
+            # dbstat is an optional SQLite build option
+            return []
+        tables = {}
+        for kind, name, table in con.execute(text(
+                "SELECT type, name, tbl_name FROM sqlite_master WHERE type IN ('table', 'index')")):
+            entry = tables.setdefault(table, [table, 0, []])
+            if kind == 'table':
+                entry[1] = pages.get(name, 0)
+            else:
+                entry[2].append((name, pages.get(name, 0)))
+    else:
+        tables = {}
+        for table, index, table_bytes, index_bytes in con.execute(text('''
+                SELECT t.relname, i.relname, pg_relation_size(t.oid), pg_relation_size(i.oid)
+                FROM pg_class t
+                JOIN pg_namespace n ON n.oid = t.relnamespace
+                LEFT JOIN pg_index x ON x.indrelid = t.oid
+                LEFT JOIN pg_class i ON i.oid = x.indexrelid
+                WHERE t.relkind = 'r' AND n.nspname = current_schema()''')):
+            entry = tables.setdefault(table, [table, table_bytes, []])
+            if index is not None:
+                entry[2].append((index, index_bytes))
+    result = [(table, size, sorted(indexes, key=lambda i: -i[1])) for table, size, indexes in tables.values()]
+    return sorted(result, key=lambda t: -(t[1] + sum(i[1] for i in t[2])))
+
+
+def archive_size():
+    # (files, bytes) under archive_dir
+    files = size = 0
+    for directory, _, names in os.walk(archive_dir):
+        for name in names:
+            if name.endswith('.jsonl.gz'):
+                files += 1
+                size += os.path.getsize(os.path.join(directory, name))
+    return files, size
+
+
+def database_info(con):
+    info = {}
+    if con.dialect.name == 'sqlite':
+        page_size = con.exec_driver_sql('PRAGMA page_size').scalar()
+        info['file'] = con.exec_driver_sql('PRAGMA page_count').scalar() * page_size
+        info['free'] = con.exec_driver_sql('PRAGMA freelist_count').scalar() * page_size
+        path = con.engine.url.database
+        info['wal'] = os.path.getsize(path + '-wal') if os.path.exists(path + '-wal') else 0
+        info['auto_vacuum'] = {0: 'none', 1: 'full', 2: 'incremental'}[
+            con.exec_driver_sql('PRAGMA auto_vacuum').scalar()]
+    else:
+        info['file'] = con.execute(text('SELECT pg_database_size(current_database())')).scalar()
+    info['archive_files'], info['archive'] = archive_size()
+    return info
+
+
+def mib(size):
+    return '%.1f MiB' % (size / 2 ** 20)
+
+
+def format_sizes(tables, info):
+    lines = ['База: %s' % mib(info['file'])]
+    if 'free' in info:
+        lines.append('Свободно внутри файла: %s, WAL: %s, auto_vacuum: %s'
+                     % (mib(info['free']), mib(info['wal']), info['auto_vacuum']))
+    lines.append('Архив: %d файлов, %s' % (info['archive_files'], mib(info['archive'])))
+    if not tables:
+        lines.append('Размеры таблиц недоступны: SQLite собран без dbstat.')
+    for table, size, indexes in tables:
+        lines.append('')
+        lines.append('%s: %s, индексы %s' % (table, mib(size), mib(sum(i[1] for i in indexes))))
+        for index, index_size in indexes:
+            lines.append('  %s: %s' % (index, mib(index_size)))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['archive', 'vacuum', 'sizes'])
+    parser.add_argument('--days', type=int, help='archive records older than this, default RETENTION_DAYS')
+    parser.add_argument('--full', action='store_true', help='full VACUUM, enables incremental vacuum on SQLite')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.INFO)
+    engine = db.init(logger=logger)
+    if args.command == 'archive':
+        if not (args.days or retention_days):
+            parser.error('set --days or RETENTION_DAYS')
+        users, moved = archive(engine, args.days)
+        logger.info('Archived %d records of %d users to %s', moved, users, archive_dir)
+    elif args.command == 'vacuum':
+        vacuum(engine, full=args.full)
+    else:
+        with engine.connect() as con:
+            print(format_sizes(sizes(con), database_info(con)))
+
+
+if __name__ == '__main__':
+    main()
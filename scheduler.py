@@ -0,0 +1,152 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import select
+
+import models # bot's database model
+
+
+logger = logging.getLogger(__name__)
+
+reminder_table = models.Reminder.__table__
+
+
+def parse_minute(value):
+    # 'HH:MM' -> minutes after midnight
+    hours, minutes = value.split(':')
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError(value)
+    return hours * 60 + minutes
+
+
+def format_minute(minute):
+    return '%02d:%02d' % divmod(minute, 60)
+
+
+def in_quiet_hours(minute, start, end):
+    if start is None or end is None or start == end:
+        return False
+    if start < end:
+        return start <= minute < end
+    return minute >= start or minute < end # window wraps past midnight
+
+
+def next_due(reminder, now=None):
+    # Next send time as a UTC timestamp; a reminder inside quiet hours
+    # waits until they end
+    tz = ZoneInfo(reminder['tz'])
+    local_now = datetime.fromtimestamp(now if now is not None else time.time(), tz)
+    minute = reminder['minute']
+    if in_quiet_hours(minute, reminder['quiet_start'], reminder['quiet_end']):
+        minute = reminder['quiet_end']
+    due = local_now.replace(hour=minute // 60, minute=minute % 60, second=0, microsecond=0)
+    if due <= local_now:
+        due = (due + timedelta(days=1)).replace(hour=minute // 60, minute=minute % 60)
+    return due.timestamp()
+
+
+class ReminderScheduler:
+    # One heap entry per active reminder, ordered by due time. Changed or
+    # cancelled reminders leave a stale entry behind that is skipped when
+    # popped; the heap is rebuilt when stale entries outnumber live ones.
+    # Due reminders are sent at most `rate` per second.
+    def __init__(self, send, rate=20, owns=None):
+        self.send = send # send(reminder dict)
+        self.owns = owns # owns(chat_id): whether this process sends the chat's reminders
+        self.interval = 1 / rate
+        self.heap = []
+        self.active = {} # user_id -> (version, reminder dict)
+        self.versions = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopping = False
+        self.sent = 0
+
+    def load(self, conn):
+        # Rebuild the schedule from the reminders table in one pass
+        rows = conn.execute(select(reminder_table).where(reminder_table.c.enabled == True)).fetchall()
+        if self.owns is not None:
+            rows = [row for row in rows if self.owns(row.chat_id)]
+        now = time.time()
+        with self.condition:
+            self.active.clear()
+            self.heap = []
+            for row in rows:
+                reminder = dict(row._mapping)
+                version = next(self.versions)
+                self.active[reminder['user_id']] = (version, reminder)
+                self.heap.append((next_due(reminder, now), version, reminder['user_id']))
+            heapq.heapify(self.heap)
+            self.condition.notify()
+        return len(rows)
+
+    def schedule(self, reminder):
+        with self.condition:
+            version = next(self.versions)
+            self.active[reminder['user_id']] = (version, reminder)
+            heapq.heappush(self.heap, (next_due(reminder), version, reminder['user_id']))
+            self.compact()
+            self.condition.notify()
+
+    def cancel(self, user_id):
+        with self.condition:
+            self.active.pop(user_id, None)
+            self.compact()
+
+    def compact(self):
+        # Called with the condition held
+        if len(self.heap) > 2 * len(self.active) + 64:
+            self.heap = [entry for entry in self.heap
+                         if self.active.get(entry[2], (None,))[0] == entry[1]]
+            heapq.heapify(self.heap)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='reminders', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+    def pop_due(self):
+        # Wait for the earliest live reminder to fall due and return it
+        with self.condition:
+            while not self.stopping:
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                due, version, user_id = self.heap[0]
+                current = self.active.get(user_id)
+                if current is None or current[0] != version:
+                    heapq.heappop(self.heap)
+                    continue
+                delay = due - time.time()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                heapq.heappop(self.heap)
+                reminder = current[1]
+                heapq.heappush(self.heap, (next_due(reminder, due + 60), version, user_id))
+                return reminder
+            return None
+
+    def run(self):
+        while True:
+            reminder = self.pop_due()
+            if reminder is None:
+                return
+            try:
+                self.send(reminder)
+                self.sent += 1
+            except Exception:
+                logger.exception('Failed to send reminder to %s', reminder['user_id'])
+            time.sleep(self.interval)
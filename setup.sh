@@ -3,4 +3,5 @@ python3 -m pip install \
   python_telegram_bot \
   pandas \
   openpyxl \
+  pyarrow \
   matplotlib
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Per-user rollups behind /stats.
+# Rebuild them from existing records with: python stats.py rebuild [--user ID]
+
+import argparse
+import logging
+from collections import Counter
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select
+
+import models # bot's database model
+import answers # answer codes
+import retention # archived records
+from replies import replies # bot's texts collection
+
+
+logger = logging.getLogger(__name__)
+
+aggregate_table = models.UserAggregate.__table__
+record_table = models.Record.__table__
+
+# Topics answered with keyboard buttons; free text is counted as other_key
+answer_keys = answers.topics
+other_key = 'другое'
+rebuild_chunk = 5000
+
+
+def day_key(dt):
+    return dt.strftime('%Y-%m-%d')
+
+
+def week_key(dt):
+    return dt.strftime('%G-W%V')
+
+
+def month_key(dt):
+    return dt.strftime('%Y-%m')
+
+
+def answer_key(topic, code):
+    if code is None:
+        return None
+    return answers.codebook.label(topic, code) or other_key
+
+
+def record_keys(record):
+    # (kind, key) counters one record contributes to
+    dt = record['datetime']
+    if isinstance(dt, str):
+        dt = datetime.fromisoformat(dt)
+    keys = [('total', ''), ('day', day_key(dt)), ('week', week_key(dt)), ('month', month_key(dt))]
+    if record['rating'] is not None:
+        keys.append(('rating', str(record['rating'])))
+    for topic in answer_keys:
+        key = answer_key(topic, record[topic])
+        if key is not None:
+            keys.append(('topic:' + topic, key))
+    return keys
+
+
+def record_values(record):
+    if isinstance(record, models.Record):
+        return {c: getattr(record, c) for c in ['user_id', 'datetime', 'rating'] + list(answer_keys)}
+    return record
+
+
+def increments(records):
+    counts = Counter()
+    for record in records:
+        record = record_values(record)
+        for kind, key in record_keys(record):
+            counts[(record['user_id'], kind, key)] += 1
+    return counts
+
+
+def upsert(dialect):
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    stmt = insert(aggregate_table)
+    return stmt.on_conflict_do_update(
+        index_elements=['user_id', 'kind', 'key'],
+        set_={'count': aggregate_table.c.count + stmt.excluded.count})
+
+
+def apply(conn, counts):
+    # conn is the Connection of the transaction that writes the records
+    if not counts:
+        return
+    conn.execute(upsert(conn.dialect.name),
+                 [{'user_id': user_id, 'kind': kind, 'key': key, 'count': count}
+                  for (user_id, kind, key), count in counts.items()])
+
+
+def rebuild(conn, user_id=None):
+    # Recount the rollups from records, live and archived, inside the
+    # caller's transaction. Rows come user by user, so counts are written
+    # once per key.
+    columns = [record_table.c[c] for c in ['user_id', 'datetime', 'rating'] + list(answer_keys)]
+    query = select(*columns).order_by(record_table.c.user_id)
+    clear = delete(aggregate_table)
+    if user_id is not None:
+        query = query.where(record_table.c.user_id == user_id)
+        clear = clear.where(aggregate_table.c.user_id == user_id)
+    conn.execute(clear)
+    result = conn.execution_options(stream_results=True).execute(query)
+    total = 0
+    counts = Counter()
+    while True:
+        rows = result.fetchmany(rebuild_chunk)
+        if not rows:
+            break
+        counts.update(increments(row._mapping for row in rows))
+        total += len(rows)
+        if len(counts) >= rebuild_chunk:
+            apply(conn, counts)
+            counts = Counter()
+    apply(conn, counts)
+    names = ['datetime', 'rating'] + list(answer_keys)
+    for archived_user in [user_id] if user_id is not None else retention.archived_users():
+        rows = [dict(zip(names, row), user_id=archived_user)
+                for row in retention.archived_rows(archived_user, names) or []]
+        apply(conn, increments(rows))
+        total += len(rows)
+    return total
+
+
+def user_stats(conn, user_id, now=None):
+    now = now or datetime.now()
+    last_days = [day_key(now - timedelta(days=i)) for i in range(7)]
+    rows = conn.execute(select(aggregate_table.c.kind, aggregate_table.c.key, aggregate_table.c.count)
+        .where(aggregate_table.c.user_id == user_id)
+        .where(aggregate_table.c.kind.in_(['total', 'rating', 'day', 'week', 'month'] +
+                                          ['topic:' + t for t in answer_keys]))
+        .where((aggregate_table.c.kind != 'day') | aggregate_table.c.key.in_(last_days))
+        .where((aggregate_table.c.kind != 'week') | (aggregate_table.c.key == week_key(now)))
+        .where((aggregate_table.c.kind != 'month') | (aggregate_table.c.key == month_key(now))))
+    stats = {'total': 0, 'last_7_days': 0, 'week': 0, 'month': 0, 'rating': {}, 'topics': {}}
+    for kind, key, count in rows:
+        if kind == 'total':
+            stats['total'] = count
+        elif kind == 'day':
+            stats['last_7_days'] += count
+        elif kind in ('week', 'month'):
+            stats[kind] = count
+        elif kind == 'rating':
+            stats['rating'][key] = count
+        else:
+            stats['topics'].setdefault(kind[len('topic:'):], {})[key] = count
+    return stats
+
+
+def topic_title(topic):
+    return replies[topic]['message'].split('\n')[0].strip('*: ')
+
+
+def format_stats(stats):
+    if stats['total'] == 0:
+        return 'Записей пока нет. Начните с /start_session'
+    lines = ['Записей всего: %d' % stats['total'],
+             'За 7 дней: %d, за эту неделю: %d, за этот месяц: %d'
+             % (stats['last_7_days'], stats['week'], stats['month']),
+             'Оценки: ' + ', '.join('%s — %d' % (k, stats['rating'].get(k, 0)) for k in ('0', '1', '2'))]
+    for topic in answer_keys:
+        answers = stats['topics'].get(topic)
+        if answers:
+            lines.append('%s: %s' % (topic_title(topic), ', '.join(
+                '%s — %d' % (k, v) for k, v in sorted(answers.items(), key=lambda x: -x[1]))))
+    return '\n'.join(lines)
+
+
+def main():
+    import db # engine and per-call sessions
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['rebuild'])
+    parser.add_argument('--user', type=int, help='rebuild one user only')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.INFO)
+    engine = db.init(logger=logger)
+    with engine.begin() as conn:
+        total = rebuild(conn, args.user)
+    logger.info('Rebuilt rollups from %d records', total)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+import importlib.util
+import logging
+import os
+from functools import partial
+from types import MappingProxyType
+
+from telegram import ReplyKeyboardMarkup
+from telegram.ext import MessageHandler, Filters
+
+
+logger = logging.getLogger(__name__)
+
+cancel_cmd = '/cancel'
+skip = 'skip'
+sep = ': '
+default_replies_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'replies.py')
+
+
+class CachedKeyboardMarkup(ReplyKeyboardMarkup):
+    # Serialised once; every send reuses the same JSON string
+    __slots__ = ('_json',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._json = super().to_json()
+
+    def to_json(self):
+        return self._json
+
+
+empty_markup = CachedKeyboardMarkup([[cancel_cmd]], one_time_keyboard=True, resize_keyboard=True)
+
+
+class Topic:
+    # One survey question compiled from its replies entry: a key -> reply
+    # lookup, the keyboard, and the states for the question and its follow-up
+    __slots__ = ('name', 'message', 'default_reply', 'replies', 'markup',
+                 'ask_state', 'follow_state', 'next_topic')
+
+    def __init__(self, name, spec, ask_state, next_topic):
+        self.name = name
+        self.message = spec['message']
+        self.default_reply = spec['default_reply']
+        self.replies = MappingProxyType({x['key']: x['reply'] if len(x['reply']) > 0 else self.default_reply
+                                         for x in spec['pairs']})
+        if spec['pairs']:
+            reply_kb = [[x['key']] for x in spec['pairs']]
+            reply_kb.append([cancel_cmd])
+            self.markup = CachedKeyboardMarkup(reply_kb, one_time_keyboard=True, resize_keyboard=True)
+        else:
+            self.markup = empty_markup
+        self.ask_state = ask_state
+        self.follow_state = ask_state + 1
+        self.next_topic = next_topic
+
+    def reply(self, text):
+        return self.replies.get(text, self.default_reply)
+
+
+class ReplyIndex:
+    # Immutable snapshot of replies.py: compiled topics in survey order plus help text
+    def __init__(self, replies, help_text):
+        names = list(replies)
+        self.replies = replies
+        self.help_text = help_text
+        self.topics = MappingProxyType({
+            name: Topic(name, replies[name], 2 * i, names[i + 1] if i + 1 < len(names) else None)
+            for i, name in enumerate(names)})
+
+    def layout(self):
+        # What the ConversationHandler states depend on
+        return [(t.name, t.ask_state, t.next_topic) for t in self.topics.values()]
+
+
+def load_replies(path):
+    spec = importlib.util.spec_from_file_location('replies_reloaded', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return ReplyIndex(module.replies, module.help_text)
+
+
+class Survey:
+    # Builds the ConversationHandler states from the replies dict, in its order.
+    # An answer whose reply is 'skip' or empty moves on to the next topic;
+    # any other reply is sent as a follow-up question, and the follow-up
+    # answer is appended to the stored one after sep.
+    def __init__(self, replies, help_text, final_topic, path=default_replies_path):
+        self.index = ReplyIndex(replies, help_text)
+        self.final_topic = final_topic
+        self.path = path
+        self.mtime = os.stat(path).st_mtime if os.path.exists(path) else None
+
+    def reload_if_changed(self):
+        # Swap in edited copy without a restart. Adding, removing or
+        # reordering topics changes the conversation states and still
+        # needs one.
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return False
+        if mtime == self.mtime:
+            return False
+        self.mtime = mtime
+        try:
+            index = load_replies(self.path)
+        except Exception:
+            logger.exception('Failed to reload %s', self.path)
+            return False
+        if index.layout() != self.index.layout():
+            logger.warning('Topics in %s changed, restart the bot to apply them', self.path)
+            return False
+        self.index = index
+        logger.info('Reloaded replies from %s', self.path)
+        return True
+
+    def state(self, name):
+        return self.index.topics[name].ask_state
+
+    def ask(self, update, name):
+        topic = self.index.topics[name]
+        update.message.reply_text(topic.message, reply_markup=topic.markup)
+        return topic.ask_state
+
+    def start(self, update, context):
+        return self.ask(update, next(iter(self.index.topics)))
+
+    def answer(self, name, update, context):
+        topic = self.index.topics[name]
+        context.user_data[name] = update.message.text
+        reply = topic.reply(update.message.text)
+        if reply == skip or len(reply) == 0:
+            return self.ask(update, topic.next_topic)
+        update.message.reply_text(reply)
+        return topic.follow_state
+
+    def follow_up(self, name, update, context):
+        context.user_data[name] += sep + update.message.text
+        return self.ask(update, self.index.topics[name].next_topic)
+
+    def state_names(self):
+        # Labels for metrics: the topic for its question, topic_follow_up for the follow-up
+        names = {}
+        for topic in self.index.topics.values():
+            names[topic.ask_state] = topic.name
+            names[topic.follow_state] = topic.name + '_follow_up'
+        return names
+
+    def states(self, final_handler):
+        # final_handler answers the last question and ends the conversation
+        text = Filters.text & ~Filters.command
+        states = {}
+        for topic in self.index.topics.values():
+            if topic.name == self.final_topic:
+                states[topic.ask_state] = [MessageHandler(text, final_handler)]
+                continue
+            states[topic.ask_state] = [MessageHandler(text, partial(self.answer, topic.name))]
+            states[topic.follow_state] = [MessageHandler(text, partial(self.follow_up, topic.name))]
+        return states
@@ -0,0 +1,155 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import db # engine and per-call sessions
+import metrics # latency histograms
+import stats # per-user rollups
+
+
+logger = logging.getLogger(__name__)
+
+stop_signal = object()
+
+
+class RecordWriter:
+    # Write-behind buffer for finished survey records.
+    # Handlers submit records and return immediately; a background thread
+    # commits them in one transaction once max_batch records are waiting
+    # or max_delay_ms has passed since the first of them arrived.
+    def __init__(self, max_batch=50, max_delay_ms=200):
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.written = 0
+        self.failed = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.listeners = [] # called with each committed batch of records
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='record-writer', daemon=True)
+                self.thread.start()
+
+    def submit(self, record):
+        # The returned future resolves once the record is committed
+        self.start()
+        future = Future()
+        self.queue.put((record, future))
+        return future
+
+    def flush(self, timeout=None):
+        # Wait until everything submitted so far is committed
+        return self.submit(None).result(timeout)
+
+    def close(self, timeout=None):
+        if self.thread is None:
+            return
+        self.queue.put(stop_signal)
+        self.thread.join(timeout)
+        logger.info('Record writer stopped: %d records written, %d failed, %d pending',
+                    self.written, self.failed, self.queue.qsize())
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'batches': self.batches,
+            'written': self.written,
+            'failed': self.failed,
+            'last_flush_ms': self.last_flush_ms,
+            'max_flush_ms': self.max_flush_ms,
+        }
+
+    def collect(self):
+        # Block for the first item, then gather more until the batch is full
+        # or the delay since the first item runs out
+        batch = [self.queue.get()]
+        if batch[0] is stop_signal:
+            return [], True
+        deadline = time.monotonic() + self.max_delay
+        # a flush marker (record None) is written at once, someone is waiting on it
+        while len(batch) < self.max_batch and batch[-1][0] is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is stop_signal:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def run(self):
+        while True:
+            batch, stopping = self.collect()
+            if batch:
+                self.write(batch)
+            if stopping:
+                # Drain anything submitted after close() was requested
+                rest = []
+                while not self.queue.empty():
+                    item = self.queue.get_nowait()
+                    if item is not stop_signal:
+                        rest.append(item)
+                if rest:
+                    self.write(rest)
+                return
+
+    def commit(self, records):
+        with db.session_scope() as session:
+            session.add_all(records)
+            # rollups are committed in the same transaction as the records
+            stats.apply(session.connection(), stats.increments(records))
+
+    def committed(self, records, elapsed):
+        metrics.stage_seconds.observe(elapsed, 'db_commit')
+        self.last_flush_ms = elapsed * 1000
+        self.max_flush_ms = max(self.max_flush_ms, self.last_flush_ms)
+        self.batches += 1
+        self.written += len(records)
+        for listener in self.listeners:
+            try:
+                listener(records)
+            except Exception:
+                logger.exception('Record writer listener failed')
+
+    def write(self, batch):
+        records = [record for record, _ in batch if record is not None]
+        started = time.perf_counter()
+        try:
+            if records:
+                self.commit(records)
+        except Exception as e:
+            # One bad record must not lose the rest of the batch
+            logger.warning('Failed to write %d records (%s), retrying one at a time', len(records), e)
+            self.write_each(batch)
+            return
+        if records:
+            self.committed(records, time.perf_counter() - started)
+        for _, future in batch:
+            future.set_result(None)
+
+    def write_each(self, batch):
+        for record, future in batch:
+            if record is None:
+                future.set_result(None)
+                continue
+            started = time.perf_counter()
+            try:
+                self.commit([record])
+            except Exception as e:
+                logger.exception('Failed to write a record of user %s', record.user_id)
+                self.failed += 1
+                future.set_exception(e)
+                continue
+            self.committed([record], time.perf_counter() - started)
+            future.set_result(None)